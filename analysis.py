@@ -0,0 +1,82 @@
+"""Phase two's work on one scene: the filmstrip, perceptual hash, palette,
+faces and colours of its sampled frames.
+
+Kept apart from scenic.py, which only runs on Windows, so the pipeline
+benchmark runs the same code as the phase two workers.
+"""
+import numpy
+from PIL import Image
+
+import face
+from color import get_colour_name, most_frequent_colours, kelly_colours
+from frames import get_numpy
+from palette import histogram
+from phash import phash
+from profiling import timings
+from tags import tag_mask
+
+
+def process_scene(clip, encoder, resize_stage, frames, path, num_colours=6,
+                  nocol=False, noface=False, faceprec=1, face_profile=None,
+                  catalog=None, match_bits=0, reuse_mask=0,
+                  video_path=None):
+    """Hand a scene's filmstrip to the encoder to save at path and tag the
+    scene. With a catalog and match_bits, the reuse_mask tags are copied
+    from a matching scene of another catalogued video than video_path
+    instead of looking for faces and colours. Returns (tag bitmask,
+    perceptual hash, colour palette or None with nocol, whether the tags
+    came from a matching scene).
+    resize_stage makes the thumb and hash frames, and the colour and face
+    frames unless those stages are switched off."""
+    sized = []
+    for frame in frames:
+        array = get_numpy(clip, frame)
+        with timings.stage("resize"):
+            sized.append(resize_stage(array))
+    # Generate the filmstrip and hand it to the writer threads
+    with timings.stage("filmstrip"):
+        stacked = numpy.concatenate([sample["thumb"] for sample in sized],
+                                    axis=0)
+        encoder.submit(stacked, path)
+
+    with timings.stage("phash"):
+        hashes = [phash(sample["hash"]) for sample in sized]
+    middle = hashes[len(hashes) // 2]
+    # The colour samples are only made when colours are wanted
+    palette = None
+    if not nocol:
+        swatches = [sample["colour"] for sample in sized]
+        with timings.stage("palette"):
+            palette = histogram(numpy.concatenate(swatches, axis=0))
+    if catalog is not None and match_bits:
+        with timings.stage("match"):
+            matched = catalog.match_tags(hashes, match_bits, reuse_mask,
+                                         path=video_path)
+        if matched is not None:
+            return (matched, middle, palette, True)
+
+    has_face = False
+    tags = []
+    for i, sample in enumerate(sized):
+        # Should we skip facial recognition?
+        if noface or i % faceprec:
+            continue
+
+        # Facial recognition
+        if not has_face:
+            # Copy the image for facial analysis
+            new = numpy.empty_like(sample["face"])
+            new[:] = sample["face"]
+            with timings.stage("face"):
+                if face.detect(new, face_profile):
+                    has_face = True
+    if not nocol:
+        img = Image.fromarray(numpy.concatenate(swatches, axis=0))
+        # Quantize the image, find the most common colours
+        with timings.stage("colour"):
+            for c in most_frequent_colours(img, top=num_colours):
+                colour = get_colour_name(c[:3])
+                tags.append(kelly_colours[colour][0])
+    if has_face:
+        tags.append("face")
+    return (tag_mask(tags), middle, palette, False)
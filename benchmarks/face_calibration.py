@@ -0,0 +1,204 @@
+"""Measure what face detection settings cost and gain.
+
+Sweeps the cascades, scale factor, minimum neighbours, minimum face size and
+analysis height over a labelled folder of images: FOLDER/faces holds images
+with at least one face and FOLDER/no_faces images without. Each setting is
+timed over every image and scored by its recall on the faces and its false
+positives on the rest.
+
+Prints the Pareto front of images per second against recall, fastest first,
+so no listed setting is beaten on both. --save writes the fastest setting
+with at least --min-recall as a profile for scenic.py --face-profile.
+
+Usage:
+  face_calibration.py [options] <FOLDER>
+  face_calibration.py --cascades
+  face_calibration.py (-h | --help)
+
+Options:
+  --orders=LIST   Cascade orders to try, separated by spaces, each a comma
+                  separated list of cascade names.
+                  [default: frontalface_alt,profileface frontalface_alt frontalface_alt2 frontalface_default]
+  --scales=LIST   Scale factors. [default: 1.1,1.2,1.3,1.5]
+  --neighbours=LIST  Minimum neighbours. [default: 3,4,5]
+  --sizes=LIST    Minimum face sizes in pixels. [default: 20]
+  --heights=LIST  Analysis heights in pixels. [default: 120,240]
+  --max-false=PCT  Leave out settings with more false positives.
+                  [default: 100]
+  --min-recall=PCT  Recall the saved profile needs. [default: 90]
+  --save=PATH     Save the chosen profile as JSON.
+  --all           List every setting, not only the Pareto front.
+  --cascades      List the cascades in the haarcascades folder.
+  -h --help       Show this screen.
+
+"""
+import itertools
+import json
+import os
+import sys
+from timeit import default_timer
+
+import numpy
+from docopt import docopt
+from PIL import Image
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(basedir))
+
+import face
+
+extensions = (".bmp", ".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp")
+
+
+def read_images(folder):
+    """Return a list of (RGB image, has a face) from a labelled folder."""
+    images = []
+    for subfolder, label in (("faces", True), ("no_faces", False)):
+        path = os.path.join(folder, subfolder)
+        if not os.path.isdir(path):
+            raise Exception("%s has no %s folder" % (folder, subfolder))
+        for fn in sorted(os.listdir(path)):
+            if os.path.splitext(fn)[1].lower() in extensions:
+                img = Image.open(os.path.join(path, fn)).convert("RGB")
+                images.append((img, label))
+    if not any(label for img, label in images):
+        raise Exception("%s/faces has no images" % folder)
+    return images
+
+
+def resize_images(images, height):
+    """The images as numpy arrays height pixels high, as the face stage
+    would see them."""
+    arrays = []
+    for img, label in images:
+        width = max(1, int(round(img.size[0] * height / float(img.size[1]))))
+        arrays.append(numpy.asarray(img.resize((width, height),
+                                               Image.BILINEAR)))
+    return arrays
+
+
+def measure(arrays, labels, profile):
+    """Time one profile over every image. Returns (images per second,
+    recall, false positive rate)."""
+    found = []
+    started = default_timer()
+    for array in arrays:
+        new = numpy.empty_like(array)
+        new[:] = array
+        found.append(bool(face.detect(new, profile)))
+    elapsed = default_timer() - started
+    faces = sum(labels)
+    hits = sum(1 for got, label in zip(found, labels) if got and label)
+    false = sum(1 for got, label in zip(found, labels) if got and not label)
+    others = len(labels) - faces
+    return (len(arrays) / max(elapsed, 1e-9), hits / float(faces),
+            false / float(others) if others else 0.)
+
+
+def sweep(images, orders, scales, neighbours, sizes, heights, report=None):
+    """Measure every combination of the settings. Returns a list of
+    (profile, images per second, recall, false positive rate)."""
+    labels = [label for img, label in images]
+    results = []
+    for height in heights:
+        arrays = resize_images(images, height)
+        for order, scale, neighbour, size in itertools.product(
+                orders, scales, neighbours, sizes):
+            profile = {
+                "cascades": order,
+                "scale_factor": scale,
+                "min_neighbours": neighbour,
+                "min_size": size,
+                "height": height,
+            }
+            result = (profile,) + measure(arrays, labels, profile)
+            results.append(result)
+            if report:
+                report(result)
+    return results
+
+
+def pareto(results):
+    """The results no other result beats on both speed and recall, fastest
+    first."""
+    front = []
+    best_recall = -1.
+    for result in sorted(results, key=lambda r: (-r[1], -r[2])):
+        if result[2] > best_recall:
+            front.append(result)
+            best_recall = result[2]
+    return front
+
+
+def describe(profile):
+    return "%-44s %5.2f %3i %4i %5i" % (
+        ",".join(profile["cascades"]), profile["scale_factor"],
+        profile["min_neighbours"], profile["min_size"], profile["height"])
+
+
+def print_table(results):
+    print("%10s %7s %7s  %-44s %5s %3s %4s %5s" % (
+        "images/s", "recall", "false", "cascades", "scale", "nb", "size",
+        "height"))
+    for profile, speed, recall, false in results:
+        print("%10.1f %6.1f%% %6.1f%%  %s" % (speed, recall * 100,
+                                             false * 100, describe(profile)))
+
+
+def is_default(profile):
+    """Whether a profile has the default settings, at any height."""
+    default = face.profiles["default"]
+    return all(profile[key] == default[key] for key in default
+               if key != "height")
+
+
+def numbers(value, kind=float):
+    return [kind(bit) for bit in value.split(",")]
+
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments.get("--cascades"):
+        for name in face.cascade_names():
+            print(name)
+        return
+    images = read_images(arguments.get("<FOLDER>"))
+    print("%i images, %i with faces" % (len(images),
+                                        sum(label for img, label in images)))
+    orders = [order.split(",") for order in arguments.get("--orders").split()]
+    for name in set(itertools.chain(*orders)):
+        face.get_cascade(name)
+    results = sweep(images, orders,
+                    numbers(arguments.get("--scales")),
+                    numbers(arguments.get("--neighbours"), int),
+                    numbers(arguments.get("--sizes"), int),
+                    numbers(arguments.get("--heights"), int),
+                    report=lambda result: sys.stdout.write("."))
+    print("")
+    max_false = float(arguments.get("--max-false")) / 100
+    results = [result for result in results if result[3] <= max_false]
+    shown = results if arguments.get("--all") else pareto(results)
+    print_table(shown)
+
+    min_recall = float(arguments.get("--min-recall")) / 100
+    chosen = [result for result in pareto(results) if result[2] >= min_recall]
+    if not chosen:
+        print("No setting reaches %.0f%% recall" % (min_recall * 100))
+        return
+    profile, speed, recall, false = chosen[0]
+    print("Fastest with at least %.0f%% recall: %.1f images/s, %.1f%% "
+          "recall, %.1f%% false positives" % (min_recall * 100, speed,
+                                              recall * 100, false * 100))
+    current = [result for result in results if is_default(result[0])]
+    if current:
+        print("The default profile at each height:")
+        print_table(current)
+    if arguments.get("--save"):
+        with open(arguments.get("--save"), "w") as f:
+            json.dump(profile, f, indent=2, sort_keys=True)
+        print("Saved to %s, use it with scenic.py --face-profile=%s" % (
+            arguments.get("--save"), arguments.get("--save")))
+
+
+if __name__ == "__main__":
+    main()
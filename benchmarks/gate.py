@@ -0,0 +1,256 @@
+"""Scenic performance gate: compare the benchmarks with a stored baseline.
+
+Each benchmark runs in its own process, several times, so its peak memory
+can be measured too. A benchmark has regressed when its median time is
+slower than the baseline's by more than --tolerance of the baseline plus
+1.5 times the larger interquartile range of the two runs, or when its peak
+memory has grown by more than --memory-tolerance. A benchmark whose process
+raises an error or dies fails the gate too.
+
+Baselines are stored per machine profile, as timings are only comparable on
+the same machine. A check runs with the same settings as its baseline.
+
+Usage:
+  gate.py --save [options]
+  gate.py [options]
+  gate.py (-h | --help)
+
+Options:
+  --save          Run the benchmarks and store them as the baseline.
+  --profile=NAME  Machine profile of the baseline. Defaults to one made from
+                  the platform, processor count and python version.
+  --baselines=DIR  Folder of baselines. Defaults to benchmarks/baselines.
+  --scenes=LIST   Comma separated video sizes in scenes. This and the
+                  options down to --seed are only used with --save.
+                  [default: 100,1000,10000]
+  --samples=N     Scenes used for the per frame benchmarks. [default: 50]
+  --frames=N      Frames sampled from each scene. [default: 4]
+  --repeat=N      Times each benchmark is run. [default: 7]
+  --seed=N        Seed for the synthetic videos. [default: 0]
+  --only=NAMES    Comma separated benchmarks to run, all by default.
+  --tolerance=PCT  Slowdown allowed beyond the noise. [default: 10]
+  --memory-tolerance=PCT  Peak memory growth allowed. [default: 20]
+  -h --help       Show this screen.
+
+"""
+import json
+import os
+import re
+import sys
+from multiprocessing import Process, Queue, freeze_support
+from Queue import Empty
+
+from docopt import docopt
+
+import run
+from synthetic import SyntheticVideo
+import memory
+
+iqr_factor = 1.5
+# Statuses that fail the gate
+regressions = ("slower", "memory", "failed")
+# Peak memory is only measured to the MB
+memory_slack = 2
+
+
+def default_profile():
+    machine = run.machine()
+    name = "%s-%s-%icpu-py%s" % (machine["platform"].split("-")[0],
+                                 machine["machine"], machine["cpus"],
+                                 ".".join(machine["python"].split(".")[:2]))
+    return re.sub(r"[^\w.-]+", "_", name).lower()
+
+
+def baseline_path(folder, profile):
+    return os.path.join(folder, "%s.json" % profile)
+
+
+def child(name, scenes, settings, output):
+    try:
+        video = SyntheticVideo(scenes, seed=settings["seed"])
+        result = run.run_benchmark(name, video, settings["frames"],
+                                   settings["repeat"])
+        result["peak_memory"] = memory.peak_memory()
+    except Exception as e:
+        result = {"failed": "%s: %s" % (type(e).__name__, e)}
+    output.put(result)
+
+
+def wait_result(process, output, poll=1.):
+    """Return the result a benchmark process sends, or a failure if it
+    exits without sending one, e.g. when it is killed or crashes."""
+    while True:
+        try:
+            return output.get(timeout=poll)
+        except Empty:
+            if not process.is_alive():
+                # The result may have been sent just before it exited
+                try:
+                    return output.get(timeout=poll)
+                except Empty:
+                    return {"failed": "exited with code %s" %
+                                      process.exitcode}
+
+
+def run_isolated(settings, names, report=None):
+    """Run each benchmark in a process of its own, returning a dictionary
+    of "name@scenes": results including peak_memory in MB. Benchmarks that
+    fail have a "failed" message instead."""
+    found = {}
+    for key, name, scenes in run.jobs(names, settings["scenes"],
+                                      settings["samples"]):
+        output = Queue()
+        process = Process(target=child, args=(name, scenes, settings, output))
+        process.start()
+        found[key] = wait_result(process, output)
+        found[key].update({"name": name, "scenes": scenes})
+        process.join()
+        if report:
+            report(key, found[key])
+    return found
+
+
+def human_time(seconds):
+    if seconds < 1e-3:
+        return "%.1f us" % (seconds * 1e6)
+    if seconds < 1:
+        return "%.2f ms" % (seconds * 1e3)
+    return "%.2f s" % seconds
+
+
+def compare(baseline, current, tolerance, memory_tolerance):
+    """Compare two sets of results. Returns a list of (key, status, baseline
+    median, current median, change, allowed change, baseline peak, current
+    peak) rows, where status is one of ok, faster, slower, memory, failed,
+    new, missing and skipped."""
+    rows = []
+    for key in sorted(set(baseline) | set(current), key=sort_key):
+        old = baseline.get(key)
+        new = current.get(key)
+        if new is not None and "failed" in new:
+            rows.append((key, "failed", None, None, None, None, None, None))
+            continue
+        if old is None or "skipped" in old:
+            rows.append((key, "new", None, None, None, None, None, None))
+            continue
+        if new is None:
+            rows.append((key, "missing", None, None, None, None, None, None))
+            continue
+        if "skipped" in new:
+            rows.append((key, "skipped", None, None, None, None, None, None))
+            continue
+        allowed = (old["median"] * tolerance +
+                   iqr_factor * max(old["iqr"], new["iqr"]))
+        change = new["median"] - old["median"]
+        status = "ok"
+        if change > allowed:
+            status = "slower"
+        elif change < -allowed:
+            status = "faster"
+        memory_allowed = (old["peak_memory"] * (1 + memory_tolerance) +
+                          memory_slack)
+        if status != "slower" and new["peak_memory"] > memory_allowed:
+            status = "memory"
+        rows.append((key, status, old["median"], new["median"],
+                     change / old["median"], allowed / old["median"],
+                     old["peak_memory"], new["peak_memory"]))
+    return rows
+
+
+def sort_key(key):
+    name, scenes = key.rsplit("@", 1)
+    return name, int(scenes)
+
+
+def print_diff(rows):
+    print("%-22s %10s %10s %8s %8s %12s  %s" % (
+        "benchmark", "baseline", "now", "change", "allowed", "memory MB",
+        "status"))
+    for key, status, old, new, change, allowed, old_peak, new_peak in rows:
+        if old is None:
+            print("%-22s %63s  %s" % (
+                key, "", status.upper() if status in regressions else status))
+            continue
+        print("%-22s %10s %10s %+7.1f%% %7.1f%% %5i -> %-4i  %s" % (
+            key, human_time(old), human_time(new), change * 100,
+            allowed * 100, old_peak, new_peak,
+            status.upper() if status in regressions else status))
+
+
+def print_progress(key, result):
+    if "failed" in result:
+        print("%-22s FAILED: %s" % (key, result["failed"]))
+    elif "skipped" in result:
+        print("%-22s skipped: %s" % (key, result["skipped"]))
+    else:
+        print("%-22s %10s  %i MB" % (key, human_time(result["median"]),
+                                     result["peak_memory"]))
+    sys.stdout.flush()
+
+
+def main():
+    arguments = docopt(__doc__)
+    profile = arguments.get("--profile") or default_profile()
+    folder = arguments.get("--baselines") or os.path.join(run.basedir,
+                                                          "baselines")
+    path = baseline_path(folder, profile)
+    names = [name for name, bench, scaled in run.benchmarks]
+    if arguments.get("--only"):
+        names = [name.strip() for name in arguments.get("--only").split(",")]
+
+    if arguments.get("--save"):
+        settings = {
+            "scenes": [int(size) for size in
+                       arguments.get("--scenes").split(",")],
+            "samples": int(arguments.get("--samples")),
+            "frames": int(arguments.get("--frames")),
+            "repeat": int(arguments.get("--repeat")),
+            "seed": int(arguments.get("--seed")),
+        }
+        found = run_isolated(settings, names, report=print_progress)
+        failed = [key for key, result in found.items() if "failed" in result]
+        if failed:
+            print("Not saving the baseline, %i benchmarks failed: %s" % (
+                len(failed), ", ".join(sorted(failed, key=sort_key))))
+            return 1
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path, "w") as f:
+            json.dump({"version": run.version,
+                       "machine": run.machine(),
+                       "settings": settings,
+                       "results": found}, f, indent=2, sort_keys=True)
+        print("Baseline for %s saved to %s" % (profile, path))
+        return 0
+
+    if not os.path.exists(path):
+        print("No baseline for %s at %s, run with --save first" % (profile,
+                                                                   path))
+        return 2
+    with open(path, "r") as f:
+        baseline = json.load(f)
+    machine = run.machine()
+    for field in ("python", "numpy"):
+        if baseline["machine"][field] != machine[field]:
+            print("Warning: the baseline was made with %s %s, this is %s" % (
+                field, baseline["machine"][field], machine[field]))
+    old = dict((key, result) for key, result in baseline["results"].items()
+               if result["name"] in names)
+    found = run_isolated(baseline["settings"], names, report=print_progress)
+    print("")
+    rows = compare(old, found, float(arguments.get("--tolerance")) / 100,
+                   float(arguments.get("--memory-tolerance")) / 100)
+    print_diff(rows)
+    failed = [row for row in rows if row[1] in regressions]
+    print("")
+    if failed:
+        print("%i of %i benchmarks regressed or failed: %s" % (
+            len(failed), len(rows), ", ".join(row[0] for row in failed)))
+        return 1
+    print("No regressions against the %s baseline" % profile)
+    return 0
+
+
+if __name__ == "__main__":
+    freeze_support()
+    sys.exit(main())
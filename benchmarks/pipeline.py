@@ -0,0 +1,85 @@
+"""The phase two worker pipeline end to end on a synthetic video.
+
+The sampled frames are drawn once into a file in the RGB32 layout Avisynth
+gives. Worker processes map that file, take scenes from a queue and run
+analysis.process_scene on each, as Analyser.process_images does: convert and
+resize the samples, save the filmstrip, hash them, make the palette, look
+for faces and name the colours.
+"""
+import os
+from multiprocessing import Process, Queue, cpu_count
+
+import numpy
+
+from synthetic import FakeClip
+
+colour_height = 96
+num_colours = 6
+
+
+def write_frames(video, frames, path):
+    """Write the RGB32 bytes of each frame to path, one after another.
+    Returns a dictionary of frame number: row in the file."""
+    index = {}
+    with open(path, "wb") as f:
+        for frame in frames:
+            if frame not in index:
+                index[frame] = len(index)
+                f.write(video.rgb32(frame))
+    return index
+
+
+def worker(path, index, width, height, tasks, done, folder):
+    """Process scenes from tasks until told to STOP, then report DONE."""
+    from analysis import process_scene
+    from encoder import ThumbnailEncoder
+    from phash import frame_height as hash_height
+    from resize import ResizeStage, scaled_size
+
+    rows = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+    rows = rows.reshape(-1, width * height * 4)
+    clip = FakeClip(width, height, dict((frame, rows[row])
+                                        for frame, row in index.items()))
+    resize_stage = ResizeStage({
+        "thumb": (width, height),
+        "colour": scaled_size(colour_height, width, height),
+        "hash": scaled_size(hash_height, width, height),
+        "face": (width, height),
+    })
+    with ThumbnailEncoder() as encoder:
+        for start, frames in iter(tasks.get, "STOP"):
+            scene_path = os.path.join(folder, "scene_%i.jpg" % start)
+            done.put((start,) + process_scene(clip, encoder, resize_stage,
+                                              frames, scene_path,
+                                              num_colours=num_colours))
+    done.put(("DONE", encoder.bytes_written))
+
+
+def run_pipeline(video, work, frames, workers=0):
+    """Return a function that runs every scene of video through workers
+    processes, by default one per processor."""
+    # Fail here, rather than in every worker, if a module is missing
+    import analysis
+
+    samples = video.sample_frames(frames)
+    path = os.path.join(work, "frames.rgb32")
+    index = write_frames(video, [f for scene in samples for f in scene], path)
+    workers = workers or cpu_count()
+
+    def run():
+        tasks = Queue()
+        done = Queue()
+        for scene in samples:
+            tasks.put((scene[0], scene))
+        processes = []
+        for i in range(workers):
+            tasks.put("STOP")
+            args = (path, index, video.width, video.height, tasks, done, work)
+            processes.append(Process(target=worker, args=args))
+        for process in processes:
+            process.start()
+        for i in range(len(samples) + workers):
+            done.get()
+        for process in processes:
+            process.join()
+    return run
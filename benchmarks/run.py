@@ -0,0 +1,331 @@
+"""Scenic benchmarks: time each hot path on synthetic videos.
+
+Runs without Avisynth, so performance work can be measured anywhere. The
+parsers and exporters are timed on videos of each --scenes size; the per
+frame work (conversion, colours, faces, filmstrips and the whole phase two
+pipeline) on --samples scenes.
+
+Usage:
+  run.py [options]
+  run.py --list
+  run.py (-h | --help)
+
+Options:
+  --scenes=LIST   Comma separated video sizes in scenes.
+                  [default: 100,1000,10000,100000]
+  --samples=N     Scenes used for the per frame benchmarks. [default: 100]
+  --frames=N      Frames sampled from each scene. [default: 4]
+  --repeat=N      Times each benchmark is run. [default: 5]
+  --only=NAMES    Comma separated benchmarks to run, all by default.
+  --output=PATH   Write the results as JSON.
+  --seed=N        Seed for the synthetic videos. [default: 0]
+  --list          List the benchmarks.
+  -h --help       Show this screen.
+
+"""
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+import numpy
+from docopt import docopt
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(basedir))
+
+from synthetic import SyntheticVideo, FakeClip
+from pipeline import run_pipeline
+from detection import (read_keyframe_flags, scenes_from_flags, read_motion,
+                       tag_motion)
+from frames import get_numpy
+from scenetable import SceneTable
+from tags import tag_mask
+
+version = 1
+thumb_height = 240
+colour_height = 96
+
+
+def sampled_frames(video, count):
+    return [frame for scene in video.sample_frames(count) for frame in scene]
+
+
+def scene_table(video):
+    """The video's scene table with its motion, colour and face tags."""
+    table = SceneTable(video.scenes(), video.fps_num, video.fps_den)
+    tag_motion(table, video.motion(), (video.width, video.height))
+    for row, (colour, face) in enumerate(zip(video.colours, video.faces)):
+        table.add_tags(row, tag_mask([colour] + (["face"] if face else [])))
+    table.frames[:] = 4
+    return table
+
+
+def scene_rows(video, table):
+    """The rows the html and xml exporters are given."""
+    from htmlgen import scene_rows
+    return scene_rows(table, "Scenes_synthetic", "synthetic.avi",
+                      (video.width, thumb_height), "jpg")
+
+
+def bench_convert(video, work, frames):
+    """get_numpy: copy RGB32 frames into numpy arrays."""
+    samples = sampled_frames(video, frames)
+    clip = FakeClip(video.width, video.height,
+                    dict((frame, numpy.frombuffer(video.rgb32(frame),
+                                                  dtype=numpy.uint8))
+                         for frame in samples))
+
+    def run():
+        for frame in samples:
+            get_numpy(clip, frame)
+    return run, len(samples)
+
+
+def bench_read_scenes(video, work, frames):
+    """Read the SCXvid log into a scene table."""
+    path = video.write_keyframe_log(os.path.join(work, "keyframes.log"))
+
+    def run():
+        with open(path, "r") as log:
+            flags = read_keyframe_flags(log)
+        scenes = scenes_from_flags(flags, video.framecount, video.min_length)
+        SceneTable(scenes, video.fps_num, video.fps_den)
+    return run, len(video)
+
+
+def bench_read_vectors(video, work, frames):
+    """Read the MDepan log and tag each scene's motion."""
+    path = video.write_motion_log(os.path.join(work, "vectors.log"))
+    scenes = video.scenes()
+
+    def run():
+        with open(path, "r") as log:
+            motion = read_motion(log)
+        table = SceneTable(scenes, video.fps_num, video.fps_den)
+        tag_motion(table, motion, (video.width, video.height))
+    return run, len(video)
+
+
+def bench_colours(video, work, frames):
+    """most_frequent_colours and closest_colour on each scene's samples."""
+    from PIL import Image
+    from color import most_frequent_colours, get_colour_name
+    size = (video.width * colour_height // video.height, colour_height)
+    swatches = []
+    for scene in video.sample_frames(frames):
+        samples = [Image.fromarray(video.frame(frame)).resize(size,
+                                                              Image.BILINEAR)
+                   for frame in scene]
+        swatches.append(numpy.concatenate([numpy.asarray(sample)
+                                           for sample in samples], axis=0))
+
+    def run():
+        for swatch in swatches:
+            img = Image.fromarray(swatch)
+            for c in most_frequent_colours(img, top=6):
+                get_colour_name(c[:3])
+    return run, len(swatches)
+
+
+def bench_faces(video, work, frames):
+    """face.detect on every sample."""
+    import face
+    samples = [video.frame(frame) for frame in sampled_frames(video, frames)]
+
+    def run():
+        for sample in samples:
+            face.detect(sample.copy())
+    return run, len(samples)
+
+
+def bench_filmstrips(video, work, frames):
+    """Encode and save a filmstrip for each scene."""
+    from encoder import ThumbnailEncoder
+    strips = [numpy.concatenate([video.frame(frame) for frame in scene],
+                                axis=0)
+              for scene in video.sample_frames(frames)]
+
+    def run():
+        with ThumbnailEncoder() as encoder:
+            for i, strip in enumerate(strips):
+                encoder.submit(strip, os.path.join(work, "scene_%i.jpg" % i))
+    return run, len(strips)
+
+
+def bench_xml(video, work, frames):
+    """write_xml for every scene."""
+    from xmlgen import write_xml
+    table = scene_table(video)
+    path = os.path.join(work, "synthetic.xml")
+
+    def run():
+        with open(path, "w") as f:
+            write_xml(f, "synthetic.avi", scene_rows(video, table),
+                      video.metadata())
+    return run, len(video)
+
+
+def bench_pipeline(video, work, frames):
+    """Phase two end to end: worker processes decoding, resizing, hashing,
+    tagging and saving each scene's filmstrip."""
+    return run_pipeline(video, work, frames), len(video)
+
+
+def html_benchmark(virtual):
+    def bench(video, work, frames):
+        from htmlgen import get_template, html_options, write_html
+        name = "template_virtual.html" if virtual else "template.html"
+        template = get_template(os.path.join(os.path.dirname(basedir),
+                                             "resources"), name)
+        table = scene_table(video)
+        path = os.path.join(work, "synthetic.html")
+
+        def run():
+            options = html_options(table, "Scenes_synthetic",
+                                   "synthetic.avi", "synthetic.avi",
+                                   (video.width, thumb_height), "jpg",
+                                   virtual=virtual)
+            with open(path, "wb") as f:
+                write_html(f, template, options)
+        return run, len(video)
+    bench.__doc__ = ("output_html with the virtual template." if virtual
+                     else "output_html with the full template.")
+    return bench
+
+
+# (name, function, whether it runs on every --scenes size)
+benchmarks = [
+    ("convert", bench_convert, False),
+    ("read_scenes", bench_read_scenes, True),
+    ("read_vectors", bench_read_vectors, True),
+    ("colours", bench_colours, False),
+    ("faces", bench_faces, False),
+    ("filmstrips", bench_filmstrips, False),
+    ("pipeline", bench_pipeline, False),
+    ("xml", bench_xml, True),
+    ("html", html_benchmark(False), True),
+    ("html_virtual", html_benchmark(True), True),
+]
+
+
+def measure(func, repeat):
+    """Return the time in seconds of each of repeat runs of func."""
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        started = default_timer()
+        func()
+        times.append(default_timer() - started)
+    return times
+
+
+def summarise(times, items):
+    times = numpy.array(times)
+    q1, median, q3 = numpy.percentile(times, [25, 50, 75])
+    return {
+        "times": times.tolist(),
+        "min": float(times.min()),
+        "median": float(median),
+        "iqr": float(q3 - q1),
+        "items": items,
+        "per_item": float(median) / max(items, 1),
+    }
+
+
+def machine():
+    """Describe the machine, so results from different ones are not
+    compared."""
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "cpus": multiprocessing.cpu_count(),
+    }
+
+
+def jobs(names, sizes, samples):
+    """Yield the (key, name, scenes) of each benchmark run, in order."""
+    for name, bench, scaled in benchmarks:
+        if name not in names:
+            continue
+        for size in (sizes if scaled else [samples]):
+            yield "%s@%i" % (name, size), name, size
+
+
+def run_benchmark(name, video, frames, repeat):
+    """Run one benchmark on a video, returning its results. Benchmarks that
+    need a module that isn't installed are skipped."""
+    bench = dict((found, func) for found, func, scaled in benchmarks)[name]
+    work = tempfile.mkdtemp(prefix="scenic_bench_")
+    try:
+        func, items = bench(video, work, frames)
+        result = summarise(measure(func, repeat), items)
+    except ImportError as e:
+        result = {"skipped": str(e)}
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    result.update({"name": name, "scenes": len(video)})
+    return result
+
+
+def run_benchmarks(names, sizes, samples, frames, repeat, seed=0,
+                   report=None):
+    """Run the named benchmarks, returning a dictionary of
+    "name@scenes": results. report, if given, is called with each key and
+    result as it finishes."""
+    found = {}
+    videos = {}
+    for key, name, size in jobs(names, sizes, samples):
+        if size not in videos:
+            videos[size] = SyntheticVideo(size, seed=seed)
+        found[key] = run_benchmark(name, videos[size], frames, repeat)
+        if report:
+            report(key, found[key])
+    return found
+
+
+def print_result(key, result):
+    if "skipped" in result:
+        print("%-24s skipped: %s" % (key, result["skipped"]))
+        return
+    print("%-24s %10.4f s  iqr %8.4f s  %10.1f us per item" % (
+        key, result["median"], result["iqr"], result["per_item"] * 1e6))
+
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments.get("--list"):
+        for name, bench, scaled in benchmarks:
+            print("%-14s %s" % (name, bench.__doc__))
+        return
+    names = [name for name, bench, scaled in benchmarks]
+    if arguments.get("--only"):
+        names = [name.strip() for name in arguments.get("--only").split(",")]
+    sizes = [int(size) for size in arguments.get("--scenes").split(",")]
+    started = time.time()
+    found = run_benchmarks(names, sizes, int(arguments.get("--samples")),
+                           int(arguments.get("--frames")),
+                           int(arguments.get("--repeat")),
+                           seed=int(arguments.get("--seed")),
+                           report=print_result)
+    if arguments.get("--output"):
+        with open(arguments.get("--output"), "w") as f:
+            json.dump({"version": version,
+                       "machine": machine(),
+                       "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "repeat": int(arguments.get("--repeat")),
+                       "seconds": time.time() - started,
+                       "results": found}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Synthetic videos with known scenes, for benchmarking without Avisynth.
+
+A SyntheticVideo is a list of scenes, each with a colour, a camera movement
+and maybe a face. It can draw any of its frames as a numpy array, either as
+RGB or as the bottom-up BGRA buffer Avisynth gives for RGB32, and write the
+SCXvid and MDepan logs that scene detection would have made. The cuts,
+movements, colours and faces the analysis should find are all known.
+"""
+import ctypes
+import os
+
+import numpy
+
+# Camera movements: (pan x, pan y, zoom) over a whole scene, as shares of the
+# frame size and a zoom factor. Each is big enough to be tagged.
+movements = {
+    "still": (0., 0., 1.),
+    "left": (-0.25, 0., 1.),
+    "right": (0.25, 0., 1.),
+    "up": (0., -0.25, 1.),
+    "down": (0., 0.25, 1.),
+    "in": (0., 0., 0.8),
+    "out": (0., 0., 1.25),
+}
+movement_names = sorted(movements)
+
+# Scene colours, a few of the Kelly colours in color.py
+colours = {
+    "vivid_red": (193, 0, 32),
+    "vivid_yellow": (255, 179, 0),
+    "strong_purple": (128, 62, 117),
+    "vivid_green": (0, 125, 52),
+    "strong_blue": (0, 83, 138),
+    "vivid_orange": (255, 104, 0),
+    "white": (255, 255, 255),
+    "black": (0, 0, 0),
+}
+colour_names = sorted(colours)
+
+skin = (224, 172, 138)
+
+
+class SyntheticVideo(object):
+    """A video of scene_count random scenes, the same for the same seed.
+       Usage: video = SyntheticVideo(1000)
+              video.scenes()[:2]
+              video.frame(10)
+       """
+
+    def __init__(self, scene_count, seed=0, width=432, height=240,
+                 fps_num=25, fps_den=1, min_length=10, max_length=60,
+                 face_share=0.3):
+        random = numpy.random.RandomState(seed)
+        self.width = width
+        self.height = height
+        self.fps_num = fps_num
+        self.fps_den = fps_den
+        self.min_length = min_length
+        self.lengths = random.randint(min_length, max_length + 1,
+                                      scene_count)
+        self.starts = numpy.concatenate([[0], numpy.cumsum(self.lengths)[:-1]])
+        self.framecount = int(self.lengths.sum())
+        self.movements = [movement_names[i] for i in
+                          random.randint(len(movements), size=scene_count)]
+        self.colours = [colour_names[i] for i in
+                        random.randint(len(colours), size=scene_count)]
+        self.faces = random.random_sample(scene_count) < face_share
+        # A texture twice the frame size, so pans have room to move
+        noise = random.random_sample((height // 8, width // 8))
+        noise = numpy.kron(noise, numpy.ones((16, 16)))
+        self.texture = 0.6 + 0.4 * noise
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def scenes(self):
+        """Return the (start, end) frames of every scene."""
+        ends = self.starts + self.lengths - 1
+        return list(zip(self.starts.tolist(), ends.tolist()))
+
+    def scene_at(self, frame):
+        return int(numpy.searchsorted(self.starts, frame, side="right")) - 1
+
+    def metadata(self):
+        """A metadata record like metadata.py's, for the xml writer."""
+        return {
+            "framecount": self.framecount,
+            "fps_num": self.fps_num,
+            "fps_den": self.fps_den,
+            "frame_rate": float(self.fps_num) / self.fps_den,
+            "width": self.width,
+            "height": self.height,
+        }
+
+    def motion(self):
+        """Return the per-frame (pan x, pan y, rotation, zoom) MDepan would
+        log, as a numpy array like detection.read_motion's."""
+        rows = numpy.zeros((self.framecount, 4))
+        rows[:, 3] = 1.
+        for start, length, name in zip(self.starts, self.lengths,
+                                       self.movements):
+            pan_x, pan_y, zoom = movements[name]
+            # The first frame of a scene has nothing to move from
+            frames = rows[start + 1:start + length]
+            frames[:, 0] = pan_x * self.width / (length - 1)
+            frames[:, 1] = pan_y * self.height / (length - 1)
+            frames[:, 3] = zoom ** (1. / (length - 1))
+        return rows
+
+    def write_keyframe_log(self, path):
+        """Write the SCXvid log, with an i-frame at each cut."""
+        flags = numpy.zeros(self.framecount, dtype=bool)
+        flags[self.starts] = True
+        lines = numpy.where(flags, "i 0 0 0 0", "p 0 0 0 0")
+        with open(path, "w") as f:
+            f.write("# XviD 2pass stat file\n\n\n")
+            f.write("\n".join(lines.tolist()))
+            f.write("\n")
+        return path
+
+    def write_motion_log(self, path):
+        """Write the MDepan log in deshaker format."""
+        rows = self.motion()
+        frames = numpy.arange(self.framecount)[:, numpy.newaxis]
+        with open(path, "w") as f:
+            numpy.savetxt(f, numpy.hstack([frames, rows]),
+                          fmt=["%i", "%.3f", "%.3f", "%.3f", "%.5f"])
+        return path
+
+    def write_logs(self, folder):
+        """Write both logs to folder, returning their paths."""
+        return (self.write_keyframe_log(os.path.join(folder,
+                                                     "keyframes.log")),
+                self.write_motion_log(os.path.join(folder, "vectors.log")))
+
+    def frame(self, frame):
+        """Draw a frame as an RGB array of shape (height, width, 3)."""
+        scene = self.scene_at(frame)
+        length = self.lengths[scene]
+        progress = (frame - self.starts[scene]) / float(max(length - 1, 1))
+        pan_x, pan_y, zoom = movements[self.movements[scene]]
+        scale = zoom ** progress
+        # Where each pixel of the frame is on the texture. MDepan logs a
+        # zoom below 1 as zooming in, so that magnifies the texture.
+        ys = numpy.arange(self.height) - self.height / 2.
+        xs = numpy.arange(self.width) - self.width / 2.
+        ys = (ys * scale + self.height * (0.5 + pan_y * progress)).astype(int)
+        xs = (xs * scale + self.width * (0.5 + pan_x * progress)).astype(int)
+        shade = self.texture[ys[:, numpy.newaxis] % self.texture.shape[0],
+                             xs % self.texture.shape[1]]
+        colour = numpy.array(colours[self.colours[scene]], dtype=float)
+        rgb = shade[..., numpy.newaxis] * colour
+        if self.faces[scene]:
+            self.draw_face(rgb, scale)
+        return rgb.clip(0, 255).astype(numpy.uint8)
+
+    def draw_face(self, rgb, scale):
+        """Draw a simple face, an oval with dark eyes and mouth, in the
+        middle of the frame."""
+        size = self.height / 3. / scale
+        cy, cx = self.height / 2., self.width / 2.
+        ys, xs = numpy.ogrid[:self.height, :self.width]
+        face = (((ys - cy) / (size * 0.6)) ** 2 +
+                ((xs - cx) / (size * 0.45)) ** 2)
+        rgb[face <= 1] = skin
+        for dx in (-0.18, 0.18):
+            eye = (((ys - cy + size * 0.12) / (size * 0.07)) ** 2 +
+                   ((xs - cx - dx * size) / (size * 0.1)) ** 2)
+            rgb[eye <= 1] = (40, 30, 30)
+        mouth = (((ys - cy - size * 0.28) / (size * 0.05)) ** 2 +
+                 ((xs - cx) / (size * 0.2)) ** 2)
+        rgb[mouth <= 1] = (120, 40, 40)
+
+    def rgb32(self, frame):
+        """Return a frame as the bytes of an Avisynth RGB32 frame: BGRA
+        pixels with the bottom row first."""
+        rgb = self.frame(frame)[:, ::-1]
+        argb = numpy.empty(rgb.shape[:2] + (4,), dtype=numpy.uint8)
+        argb[..., 0] = 255
+        argb[..., 1:] = rgb
+        return argb.ravel()[::-1].tobytes()
+
+    def sample_frames(self, count):
+        """Return count evenly spread frames from each scene, the way phase
+        two samples them."""
+        samples = []
+        for start, length in zip(self.starts.tolist(), self.lengths.tolist()):
+            step = length / float(count)
+            samples.append([start + int(i * step) for i in range(count)])
+        return samples
+
+
+class BitmapHeader(object):
+    def __init__(self, width):
+        self.biWidth = width
+
+
+class FakeClip(object):
+    """Stands in for an RGB32 AvsClip for frames.get_numpy. frames is a
+    dictionary of frame number: uint8 array of the frame's RGB32 bytes,
+    already drawn so only copying them into the frame buffer counts as
+    decoding."""
+
+    def __init__(self, width, height, frames):
+        self.Height = height
+        self.bmih = BitmapHeader(width)
+        self.buffer = (ctypes.c_ubyte * (width * height * 4))()
+        self.pBits = ctypes.cast(self.buffer, ctypes.POINTER(ctypes.c_ubyte))
+        self.frames = frames
+
+    def _GetFrame(self, frame):
+        data = self.frames[frame]
+        ctypes.memmove(self.buffer, data.ctypes.data, data.nbytes)
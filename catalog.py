@@ -0,0 +1,395 @@
+"""A SQLite catalog of every analysed video's scenes, so tags can be searched
+across a whole library without opening each html index.
+
+Each scene keeps its tag bitmask (see tags.py), and scene_tags holds one
+indexed row per tag set on a scene. A query starts from the index entries of
+its rarest tag and checks the rest against the bitmask.
+
+scene_hashes holds each scene's perceptual hash with an index on each of its
+chunks, a persistent version of phash.MultiIndex.
+
+scene_palettes holds each scene's colour palette (palette.py) and the
+inverted list it belongs to, with the list centroids in palette_centroids.
+The centroids are trained once there are enough palettes and again each time
+the catalog grows eightfold.
+"""
+import os
+import sqlite3
+import sys
+
+import numpy
+
+import palette
+import phash
+from tags import tag_bits, tag_mask, mask_tags
+
+schema = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    framecount INTEGER,
+    fps_num INTEGER,
+    fps_den INTEGER,
+    html TEXT,
+    tagged INTEGER
+);
+CREATE TABLE IF NOT EXISTS scenes (
+    id INTEGER PRIMARY KEY,
+    video_id INTEGER NOT NULL REFERENCES videos(id),
+    scene INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    ts TEXT,
+    tags INTEGER NOT NULL,
+    strip TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_video ON scenes (video_id, scene);
+CREATE TABLE IF NOT EXISTS scene_tags (
+    tag TEXT NOT NULL,
+    scene_id INTEGER NOT NULL REFERENCES scenes(id),
+    video_id INTEGER NOT NULL REFERENCES videos(id)
+);
+CREATE INDEX IF NOT EXISTS scene_tags_tag ON scene_tags (tag, scene_id);
+CREATE INDEX IF NOT EXISTS scene_tags_video ON scene_tags (video_id);
+CREATE TABLE IF NOT EXISTS scene_hashes (
+    scene_id INTEGER NOT NULL REFERENCES scenes(id),
+    video_id INTEGER NOT NULL REFERENCES videos(id),
+    hash INTEGER NOT NULL,
+    c0 INTEGER NOT NULL,
+    c1 INTEGER NOT NULL,
+    c2 INTEGER NOT NULL,
+    c3 INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scene_hashes_c0 ON scene_hashes (c0);
+CREATE INDEX IF NOT EXISTS scene_hashes_c1 ON scene_hashes (c1);
+CREATE INDEX IF NOT EXISTS scene_hashes_c2 ON scene_hashes (c2);
+CREATE INDEX IF NOT EXISTS scene_hashes_c3 ON scene_hashes (c3);
+CREATE INDEX IF NOT EXISTS scene_hashes_video ON scene_hashes (video_id);
+CREATE TABLE IF NOT EXISTS scene_palettes (
+    scene_id INTEGER PRIMARY KEY REFERENCES scenes(id),
+    video_id INTEGER NOT NULL REFERENCES videos(id),
+    list INTEGER NOT NULL,
+    vector BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scene_palettes_list ON scene_palettes (list);
+CREATE INDEX IF NOT EXISTS scene_palettes_video ON scene_palettes (video_id);
+CREATE TABLE IF NOT EXISTS palette_centroids (
+    list INTEGER PRIMARY KEY,
+    vector BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+# Palettes needed before the inverted lists are first trained
+train_minimum = 4096
+# Lists searched for each palette query
+list_probes = 8
+
+
+def text(value):
+    """Decode byte string paths, which SQLite refuses unless they are ASCII."""
+    if isinstance(value, str):
+        return value.decode(sys.getfilesystemencoding() or "utf-8")
+    return value
+
+
+def blobs_array(blobs):
+    """Join palette blobs into one array with a row per palette."""
+    data = b"".join(bytes(blob) for blob in blobs)
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, palette.bins)
+
+
+class Catalog(object):
+    """A connection to the catalog database, created if needed.
+       Usage: with Catalog(path) as catalog:
+                  catalog.upsert(video, scenes)
+                  results = catalog.query(["red", "face"])
+       """
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(schema)
+        # Catalogs made before videos recorded the tags looked for
+        columns = [row[1] for row in
+                   self.db.execute("PRAGMA table_info(videos)")]
+        if "tagged" not in columns:
+            self.db.execute("ALTER TABLE videos ADD COLUMN tagged INTEGER")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def upsert(self, video, scenes):
+        """Add or replace a video and all its scenes.
+
+        video is a dictionary with path, size, mtime, framecount, fps_num,
+        fps_den, html and tagged, the bitmask of the tags phase two looked
+        for. scenes is an iterable of (scene, start, end, start_time,
+        end_time, ts, tags, strip, perceptual hash, palette) tuples. A hash
+        of 0 or a palette of None means the scene has none."""
+        fields = ["size", "mtime", "framecount", "fps_num", "fps_den", "html",
+                  "tagged"]
+        values = [text(video.get(field)) for field in fields]
+        path = text(video["path"])
+        with self.db:
+            row = self.db.execute("SELECT id FROM videos WHERE path = ?",
+                                  (path,)).fetchone()
+            if row:
+                video_id = row[0]
+                self.db.execute(
+                    "UPDATE videos SET %s WHERE id = ?" %
+                    ", ".join("%s = ?" % field for field in fields),
+                    values + [video_id])
+                self.db.execute("DELETE FROM scene_tags WHERE video_id = ?",
+                                (video_id,))
+                self.db.execute("DELETE FROM scene_hashes WHERE video_id = ?",
+                                (video_id,))
+                self.db.execute("DELETE FROM scene_palettes "
+                                "WHERE video_id = ?", (video_id,))
+                self.db.execute("DELETE FROM scenes WHERE video_id = ?",
+                                (video_id,))
+            else:
+                cursor = self.db.execute(
+                    "INSERT INTO videos (path, %s) VALUES (?, %s)" %
+                    (", ".join(fields), ", ".join("?" * len(fields))),
+                    [path] + values)
+                video_id = cursor.lastrowid
+            tag_rows = []
+            hash_rows = []
+            palette_ids = []
+            palettes = []
+            for scene in scenes:
+                cursor = self.db.execute(
+                    "INSERT INTO scenes (video_id, scene, start, end, "
+                    "start_time, end_time, ts, tags, strip) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (video_id,) + tuple(scene[:7]) + (text(scene[7]),))
+                scene_id = cursor.lastrowid
+                tag_rows.extend((name, scene_id, video_id)
+                                for name in mask_tags(scene[6]))
+                if scene[8]:
+                    hash_rows.append([scene_id, video_id,
+                                      phash.signed(scene[8])] +
+                                     phash.chunks(scene[8]))
+                if scene[9] is not None:
+                    palette_ids.append(scene_id)
+                    palettes.append(scene[9])
+            self.db.executemany("INSERT INTO scene_tags (tag, scene_id, "
+                                "video_id) VALUES (?, ?, ?)", tag_rows)
+            self.db.executemany("INSERT INTO scene_hashes (scene_id, "
+                                "video_id, hash, c0, c1, c2, c3) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", hash_rows)
+            if palettes:
+                vectors = numpy.array(palettes, dtype=numpy.uint8)
+                lists = self.assign_lists(vectors)
+                self.db.executemany(
+                    "INSERT INTO scene_palettes (scene_id, video_id, list, "
+                    "vector) VALUES (?, ?, ?, ?)",
+                    [(scene_id, video_id, int(lst),
+                      sqlite3.Binary(vector.tobytes()))
+                     for scene_id, lst, vector in zip(palette_ids, lists,
+                                                      vectors)])
+            self.train_lists()
+        return video_id
+
+    def tag_count(self, name):
+        """Number of scenes in the catalog with a tag."""
+        return self.db.execute("SELECT COUNT(*) FROM scene_tags WHERE tag = ?",
+                               (name,)).fetchone()[0]
+
+    def query(self, names, limit=0):
+        """Return (video path, scene, start, end, ts, strip) for every scene
+        with all the named tags, in video and frame order."""
+        unknown = [name for name in names if name not in tag_bits]
+        if unknown:
+            raise Exception("Unknown tags: %s" % ", ".join(unknown))
+        mask = tag_mask(names)
+        rarest = min(names, key=self.tag_count)
+        sql = ("SELECT v.path, s.scene, s.start, s.end, s.ts, s.strip "
+               "FROM scene_tags t "
+               "JOIN scenes s ON s.id = t.scene_id "
+               "JOIN videos v ON v.id = s.video_id "
+               "WHERE t.tag = ? AND (s.tags & ?) = ? "
+               "ORDER BY v.path, s.start")
+        args = [rarest, mask, mask]
+        if limit:
+            sql += " LIMIT ?"
+            args.append(limit)
+        return self.db.execute(sql, args).fetchall()
+
+    def similar(self, value, max_bits):
+        """Return a list of (distance, scene id) for the catalogued scenes
+        whose hash is within max_bits of value, nearest first."""
+        if max_bits > phash.max_distance:
+            raise ValueError("Hashes can be searched up to %i bits apart"
+                             % phash.max_distance)
+        candidates = {}
+        for i, chunk in enumerate(phash.chunks(value)):
+            values = phash.probes(chunk, max_bits)
+            rows = self.db.execute(
+                "SELECT scene_id, hash FROM scene_hashes WHERE c%i IN (%s)" %
+                (i, ", ".join("?" * len(values))), values)
+            candidates.update(rows)
+        found = []
+        for scene_id, other in candidates.items():
+            bits = phash.distance(value, phash.unsigned(other))
+            if bits <= max_bits:
+                found.append((bits, scene_id))
+        return sorted(found)
+
+    def match_tags(self, hashes, max_bits, mask, path=None):
+        """Return the mask tags of the catalogued scene nearest to any of a
+        scene's sample hashes, or None if none is within max_bits. Only
+        scenes of videos other than path, whose analysis looked for every
+        tag in mask, are used."""
+        found = []
+        for value in hashes:
+            found.extend(self.similar(value, max_bits))
+        exclude = text(path) if path else None
+        for bits, scene_id in sorted(found):
+            tags, other, tagged = self.db.execute(
+                "SELECT s.tags, v.path, v.tagged FROM scenes s "
+                "JOIN videos v ON v.id = s.video_id WHERE s.id = ?",
+                (scene_id,)).fetchone()
+            # Catalogs made before tagged was recorded can't tell
+            if other == exclude or tagged is None or tagged & mask != mask:
+                continue
+            return tags & mask
+        return None
+
+    def duplicates(self, max_bits, paths=None):
+        """Return a list of groups of near-duplicate scenes, each a list of
+        (video path, scene, ts) in video and frame order. With paths, only
+        groups including a scene of one of those videos are returned.
+        Each scene's neighbours are found through the chunk indexes, as in
+        similar."""
+        sql = "SELECT scene_id, hash FROM scene_hashes"
+        args = []
+        if paths:
+            sql += (" WHERE video_id IN (SELECT id FROM videos "
+                    "WHERE path IN (%s))" % ", ".join("?" * len(paths)))
+            args = [text(path) for path in paths]
+        sql += " ORDER BY scene_id"
+        groups = []
+        grouped = set()
+        for scene_id, value in self.db.execute(sql, args):
+            if scene_id in grouped:
+                continue
+            found = [key for bits, key in
+                     self.similar(phash.unsigned(value), max_bits)]
+            if len(found) > 1:
+                grouped.update(found)
+                groups.append(sorted(self.db.execute(
+                    "SELECT v.path, s.scene, s.ts FROM scenes s "
+                    "JOIN videos v ON v.id = s.video_id WHERE s.id IN (%s)"
+                    % ", ".join("?" * len(found)), found).fetchall()))
+        return groups
+
+    def get_setting(self, name, default=None):
+        row = self.db.execute("SELECT value FROM settings WHERE name = ?",
+                              (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, name, value):
+        self.db.execute("INSERT OR REPLACE INTO settings (name, value) "
+                        "VALUES (?, ?)", (name, value))
+
+    def centroids(self):
+        """Return the palette list centroids, None until trained."""
+        rows = self.db.execute("SELECT vector FROM palette_centroids "
+                               "ORDER BY list").fetchall()
+        if not rows:
+            return None
+        return blobs_array(row[0] for row in rows).astype(numpy.float32)
+
+    def assign_lists(self, vectors):
+        """Return the inverted list of each palette."""
+        centroids = self.centroids()
+        if centroids is None:
+            return numpy.zeros(len(vectors), dtype=numpy.int64)
+        return palette.nearest(vectors, centroids)
+
+    def train_lists(self):
+        """Train the palette list centroids and put every palette in its
+        list, when the catalog has grown enough since the last time."""
+        count = self.db.execute("SELECT COUNT(*) FROM scene_palettes"
+                                ).fetchone()[0]
+        trained = self.get_setting("palettes_trained", 0)
+        if count < train_minimum or (trained and count < trained * 8):
+            return
+        rows = self.db.execute("SELECT scene_id, vector FROM scene_palettes"
+                               ).fetchall()
+        ids = [row[0] for row in rows]
+        vectors = blobs_array(row[1] for row in rows)
+        centroids = palette.kmeans(vectors, palette.list_count(count))
+        lists = palette.nearest(vectors, centroids)
+        self.db.execute("DELETE FROM palette_centroids")
+        self.db.executemany(
+            "INSERT INTO palette_centroids (list, vector) VALUES (?, ?)",
+            [(i, sqlite3.Binary(centroid.astype(numpy.uint8).tobytes()))
+             for i, centroid in enumerate(numpy.round(centroids))])
+        self.db.executemany("UPDATE scene_palettes SET list = ? "
+                            "WHERE scene_id = ?",
+                            zip(lists.tolist(), ids))
+        self.set_setting("palettes_trained", count)
+
+    def scene_palette(self, path, scene):
+        """Return the palette of a catalogued scene."""
+        row = self.db.execute(
+            "SELECT p.vector FROM scene_palettes p "
+            "JOIN scenes s ON s.id = p.scene_id "
+            "JOIN videos v ON v.id = s.video_id "
+            "WHERE v.path = ? AND s.scene = ?",
+            (text(path), scene)).fetchone()
+        if not row:
+            raise Exception("Scene %i of %s has no palette in the catalog"
+                            % (scene, path))
+        return blobs_array([row[0]])[0]
+
+    def similar_palettes(self, query, limit=20, probes=list_probes):
+        """Return (distance, video path, scene, ts, strip) for the scenes
+        whose palettes are nearest to query, searching the probes nearest
+        inverted lists."""
+        query = numpy.asarray(query, dtype=numpy.float32)
+        centroids = self.centroids()
+        lists = [0]
+        if centroids is not None:
+            lists = numpy.argsort(palette.distances(query, centroids))
+            lists = lists[:probes].tolist()
+        rows = self.db.execute(
+            "SELECT scene_id, vector FROM scene_palettes WHERE list IN (%s)"
+            % ", ".join("?" * len(lists)), lists).fetchall()
+        if not rows:
+            return []
+        vectors = blobs_array(row[1] for row in rows)
+        found = palette.distances(query, vectors)
+        best = numpy.argsort(found)[:limit] if limit else numpy.argsort(found)
+        results = []
+        for i in best.tolist():
+            path, scene, ts, strip = self.db.execute(
+                "SELECT v.path, s.scene, s.ts, s.strip FROM scenes s "
+                "JOIN videos v ON v.id = s.video_id WHERE s.id = ?",
+                (rows[i][0],)).fetchone()
+            results.append((float(found[i]), path, scene, ts, strip))
+        return results
+
+    def videos(self):
+        return self.db.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
@@ -0,0 +1,61 @@
+"""Find the black bars (letterbox and pillarbox) around a video's picture."""
+import numpy
+
+# Pixels with no channel above this are black
+threshold = 24
+# Share of bright pixels a line can have and still count as border, which
+# allows for noise and compression artefacts in the bars
+tolerance = 0.02
+# Bars this much of the frame or more are more likely dark content
+max_share = 0.4
+
+
+def edge(dark):
+    """Number of leading True values in a sequence of flags."""
+    if dark.all():
+        return len(dark)
+    return int(numpy.argmin(dark))
+
+
+def even(pixels):
+    """Round down to an even number, as YV12 can only be cropped by 2."""
+    return pixels - pixels % 2
+
+
+def find_borders(frames):
+    """Given an iterable of RGB frames as numpy arrays, return the border
+    (left, top, right, bottom) in pixels that is black in every frame."""
+    brightest = None
+    for frame in frames:
+        # Brightest channel of each pixel over all the frames
+        bright = frame.max(axis=2)
+        if brightest is None:
+            brightest = bright
+        else:
+            brightest = numpy.maximum(brightest, bright)
+    if brightest is None:
+        return (0, 0, 0, 0)
+    lit = brightest > threshold
+    dark_rows = lit.mean(axis=1) <= tolerance
+    dark_cols = lit.mean(axis=0) <= tolerance
+    if dark_rows.all():
+        # Every sampled frame was black
+        return (0, 0, 0, 0)
+    height, width = lit.shape
+    top = even(edge(dark_rows))
+    bottom = even(edge(dark_rows[::-1]))
+    left = even(edge(dark_cols))
+    right = even(edge(dark_cols[::-1]))
+    if top + bottom > height * max_share:
+        top = bottom = 0
+    if left + right > width * max_share:
+        left = right = 0
+    return (left, top, right, bottom)
+
+
+def crop_script(borders):
+    """Avisynth line cropping the borders off, or an empty string."""
+    if not any(borders):
+        return ""
+    left, top, right, bottom = borders
+    return "Crop(%i, %i, %i, %i)" % (left, top, -right, -bottom)
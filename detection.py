@@ -0,0 +1,109 @@
+import numpy
+
+from tags import tag_mask
+
+
+def read_keyframe_flags(lines):
+    """Given the lines of an SCXvid log, return a list with one boolean per
+    frame that is True where SCXvid found a keyframe."""
+    # The log file starts with 3 unneeded lines
+    return [line.startswith("i") for line in list(lines)[3:]]
+
+
+def scenes_from_flags(flags, framecount, min_slength):
+    """Turn per-frame keyframe flags into a list of (start, end) scenes no
+    shorter than min_slength frames."""
+    keyframes = [0]
+    endframes = []
+    for i, flag in enumerate(flags):
+        # Minimum scene length in frames
+        slength = (i - keyframes[-1])
+        if flag and slength >= min_slength:
+            keyframes.append(i)
+            endframes.append(i - 1)
+    if not endframes:
+        raise Exception("Error: video file only had once scene :(")
+    # Make sure we add the last scene
+    if endframes[-1] != framecount:
+        keyframes.append(endframes[-1] + 1)
+        endframes.append(framecount)
+    return zip(keyframes, endframes)
+
+
+def candidate_windows(flags, framecount, pad):
+    """Return merged (start, end) frame windows, pad frames either side of
+    every flagged frame after the first. Each window starts at least one
+    frame before its candidates so the fine pass has a frame to compare."""
+    windows = []
+    for i, flag in enumerate(flags):
+        if not flag or i == 0:
+            continue
+        start = max(0, i - pad)
+        end = min(framecount - 1, i + pad)
+        if windows and start <= windows[-1][1] + 1:
+            windows[-1] = (windows[-1][0], end)
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def trim_script(windows):
+    """Avisynth expression joining the frame windows into one clip."""
+    return " ++ ".join("Trim(%i, %i)" % (start, end)
+                       for start, end in windows)
+
+
+def map_window_flags(windows, window_flags, framecount):
+    """Map the flags from a pass over the joined windows back to per-frame
+    flags for the whole video. The first frame of every window is ignored
+    as the join itself looks like a cut."""
+    flags = [False] * framecount
+    offset = 0
+    for start, end in windows:
+        for i in range(1, end - start + 1):
+            if offset + i < len(window_flags) and window_flags[offset + i]:
+                flags[start + i] = True
+        offset += end - start + 1
+    return flags
+
+
+def read_motion(lines):
+    """Given the lines of an MDepan log, return a numpy array with a row of
+    (pan x, pan y, rotation, zoom) for each line. Lines without motion, such
+    as comments, count as no movement."""
+    rows = []
+    for line in lines:
+        bits = line.split()
+        row = (0., 0., 0., 1.)
+        if len(bits) >= 5:
+            try:
+                row = tuple(float(bit) for bit in bits[1:5])
+            except ValueError:
+                pass
+        rows.append(row)
+    return numpy.array(rows, dtype=numpy.float64).reshape(-1, 4)
+
+
+def tag_motion(table, motion, size):
+    """Set the motion tags and activity of each scene in a SceneTable from
+    the MDepan log as read by read_motion. size is the (width, height) the
+    motion was measured at."""
+    width, height = size
+    # Movement of each frame in frame widths
+    scale = numpy.array([width, height, 90., 1.])
+    moves = numpy.abs(motion - [0., 0., 0., 1.]) / scale
+    for row, (start, end) in enumerate(table):
+        frames = motion[start:end + 1]
+        vx, vy, vr = frames[:, :3].sum(axis=0)
+        vz = 100. * frames[:, 3].prod()
+        table.activity[row] = moves[start:end + 1].sum()
+        movements = []
+        if abs(vx) > (width / 10.):
+            movements.append("left" if vx < 0 else "right")
+        if abs(vy) > (height / 10.):
+            movements.append("down" if vy > 0 else "up")
+        if abs(vr) > 10:
+            movements.append("ccw" if vr > 0 else "cw")
+        if not (vz > 90 and vz < 110):
+            movements.append("out" if vz > 100 else "in")
+        table.add_tags(row, tag_mask(movements))
@@ -0,0 +1,105 @@
+import os
+import threading
+from Queue import Queue
+
+from PIL import Image
+
+from profiling import Timings
+
+# Extension: (PIL format name, supports chroma subsampling)
+formats = {
+    "jpg": ("JPEG", True),
+    "webp": ("WEBP", False),
+}
+
+
+def human_size(num):
+    """Return a byte count as a short human readable string."""
+    for unit in ["bytes", "KB", "MB", "GB"]:
+        if num < 1024.0:
+            return "%3.1f %s" % (num, unit)
+        num /= 1024.0
+    return "%3.1f TB" % num
+
+
+class ThumbnailEncoder(object):
+    """Encode and save filmstrips on a pool of writer threads so image
+    compression overlaps with decoding the next scene.
+       Usage: with ThumbnailEncoder(fmt="jpg", quality=80) as enc:
+                  enc.submit(numpy_array, "/path/to/scene.jpg")
+              print enc.bytes_written
+       Saving is timed as the "save" stage of timings, if given.
+       """
+
+    def __init__(self, fmt="jpg", quality=75, subsampling=2,
+                 progressive=True, threads=2, timings=None):
+        if fmt not in formats:
+            raise Exception("Unknown thumbnail format '%s'." % fmt)
+        self.fmt = fmt
+        self.quality = quality
+        self.subsampling = subsampling
+        self.progressive = progressive
+        self.timings = timings or Timings()
+        self.bytes_written = 0
+        self.files_written = 0
+        self.error = None
+        self.lock = threading.Lock()
+        # Bound the queue so a slow disk can't hold every filmstrip in memory
+        self.queue = Queue(maxsize=threads * 2)
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._writer)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def save_options(self):
+        """Keyword arguments for PIL's Image.save."""
+        pil_format, has_subsampling = formats[self.fmt]
+        options = {"format": pil_format, "quality": self.quality}
+        if has_subsampling:
+            options["subsampling"] = self.subsampling
+            options["optimize"] = self.progressive
+            options["progressive"] = self.progressive
+        return options
+
+    def _writer(self):
+        options = self.save_options()
+        for array, path in iter(self.queue.get, None):
+            try:
+                with self.timings.stage("save"):
+                    Image.fromarray(array).save(path, **options)
+                size = os.path.getsize(path)
+            except Exception as e:
+                with self.lock:
+                    self.error = self.error or e
+                continue
+            with self.lock:
+                self.bytes_written += size
+                self.files_written += 1
+
+    def submit(self, array, path):
+        """Queue a numpy image array to be written to path. The array must
+        not be modified afterwards."""
+        if self.error:
+            raise self.error
+        self.queue.put((array, path))
+
+    def close(self):
+        """Wait for all queued images to be written. Returns the total
+        number of bytes written."""
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        if self.error:
+            raise self.error
+        return self.bytes_written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        if self.threads:
+            self.close()
@@ -0,0 +1,148 @@
+"""Machine readable progress: a stream of events as JSON lines.
+
+Every event is one JSON object on its own line with at least its name, the
+time and the process id. A job runner can follow the stream to see each
+video's stages start and end and how fast they are going:
+
+    {"event": "stage_start", "stage": "phase_two", "time": ..., ...}
+    {"event": "progress", "stage": "phase_two", "done": 120, "total": 800,
+     "rate": 14.2, "eta": 47.9, "frames": 480, "frames_rate": 56.8, ...}
+
+The stream is written by the main process only. Phase two workers send
+their samples back on the results queue and the main process writes them as
+worker_progress events.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from timeit import default_timer
+
+# Seconds between progress samples of a stage or worker
+interval = 2.0
+
+
+class EventStream(object):
+    """Writes events to a file, or a file descriptor given as "fd:N". Does
+    nothing until opened, so events can be sent from anywhere.
+       Usage: stream.open("events.jsonl")
+              with stream.stage("html"):
+                  write_html()
+       """
+
+    def __init__(self):
+        self.f = None
+        self.lock = threading.Lock()
+
+    def open(self, target):
+        if target.startswith("fd:"):
+            # Line buffered, and separate from sys.stdout so --silent
+            # doesn't swallow it. The descriptor isn't ours to close.
+            self.f = os.fdopen(os.dup(int(target[3:])), "w", 1)
+        else:
+            self.f = open(target, "a", 1)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def emit(self, event, **fields):
+        if self.f is None:
+            return
+        record = {"event": event, "time": time.time(), "pid": os.getpid()}
+        record.update(fields)
+        line = json.dumps(record, separators=(",", ":"), sort_keys=True)
+        with self.lock:
+            self.f.write(line + "\n")
+            self.f.flush()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Send stage_start and stage_end events around a stage."""
+        self.emit("stage_start", stage=name, **fields)
+        started = default_timer()
+        try:
+            yield
+        except Exception as e:
+            self.emit("stage_error", stage=name, error=str(e))
+            raise
+        self.emit("stage_end", stage=name,
+                  seconds=default_timer() - started)
+
+    def progress(self, stage, total, unit):
+        """Return a Progress for a stage of total units."""
+        return Progress(self, stage, total, unit)
+
+
+class Progress(object):
+    """Sends the throughput and estimated time left of a stage, at most
+    every interval seconds and when it finishes."""
+
+    def __init__(self, stream, stage, total, unit):
+        self.stream = stream
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.started = default_timer()
+        self.last = self.started
+
+    def update(self, done, **counts):
+        """Report done units so far. Any other counts, e.g. frames, are
+        sent with their own rates."""
+        if self.stream.f is None:
+            return
+        now = default_timer()
+        if now - self.last < interval and done < self.total:
+            return
+        self.last = now
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed > 0 else 0.
+        fields = {
+            "stage": self.stage,
+            "unit": self.unit,
+            "done": done,
+            "total": self.total,
+            "elapsed": elapsed,
+            "rate": rate,
+            "eta": (self.total - done) / rate if rate else None,
+        }
+        for name, count in counts.items():
+            fields[name] = count
+            fields[name + "_rate"] = count / elapsed if elapsed > 0 else 0.
+        self.stream.emit("progress", **fields)
+
+
+class WorkerProgress(object):
+    """Counts a worker's scenes and frames, and says when it is time to send
+    a sample of them."""
+
+    def __init__(self):
+        self.started = default_timer()
+        self.last = self.started
+        self.scenes = 0
+        self.frames = 0
+
+    def add(self, frames):
+        """Count a finished scene. Returns a sample to send, or None if one
+        was sent less than interval seconds ago."""
+        self.scenes += 1
+        self.frames += frames
+        now = default_timer()
+        if now - self.last < interval:
+            return None
+        self.last = now
+        elapsed = now - self.started
+        return {
+            "worker": os.getpid(),
+            "scenes": self.scenes,
+            "frames": self.frames,
+            "elapsed": elapsed,
+            "scenes_rate": self.scenes / elapsed,
+            "frames_rate": self.frames / elapsed,
+        }
+
+
+# The main process's stream
+stream = EventStream()
@@ -1,5 +1,6 @@
 import sys
 import os
+import json
 
 if getattr(sys, 'frozen', False):
     # we are running in a |PyInstaller| bundle
@@ -10,20 +11,70 @@ else:
 
 import cv
 
-cascades = [
-    cv.Load(os.path.join(basedir,
-                         'haarcascades/haarcascade_frontalface_alt.xml')),
-    cv.Load(os.path.join(basedir,
-                         'haarcascades/haarcascade_profileface.xml')),
-]
+cascade_dir = os.path.join(basedir, "haarcascades")
 
+# A profile is the cascades to try, in order, and the detection parameters.
+# height is the frame height faces are looked for at, None for --face-height.
+# benchmarks/face_calibration.py measures profiles and can save new ones.
+profiles = {
+    "default": {
+        "cascades": ["frontalface_alt", "profileface"],
+        "scale_factor": 1.3,
+        "min_neighbours": 4,
+        "min_size": 20,
+        "height": None,
+    },
+}
 
-def detect(img):
+# Cascades loaded so far, by name
+loaded = {}
+
+
+def get_cascade(name):
+    """Load a cascade from the haarcascades folder the first time it is
+    used."""
+    if name not in loaded:
+        path = os.path.join(cascade_dir, "haarcascade_%s.xml" % name)
+        if not os.path.exists(path):
+            raise Exception("No face cascade %s at %s" % (name, path))
+        loaded[name] = cv.Load(path)
+    return loaded[name]
+
+
+def cascade_names():
+    """Names of the cascades in the haarcascades folder."""
+    return sorted(fn[len("haarcascade_"):-len(".xml")]
+                  for fn in os.listdir(cascade_dir)
+                  if fn.startswith("haarcascade_") and fn.endswith(".xml"))
+
+
+def load_profile(value):
+    """Return the profile called value, or read it from a JSON file saved
+    by the calibration harness. Anything the file leaves out is taken from
+    the default profile."""
+    if value in profiles:
+        return profiles[value]
+    if not os.path.isfile(value):
+        raise Exception("%s is not a face profile (%s) or a profile file" % (
+            value, ", ".join(sorted(profiles))))
+    with open(value, "r") as f:
+        profile = dict(profiles["default"])
+        profile.update(json.load(f))
+    for name in profile["cascades"]:
+        get_cascade(name)
+    return profile
+
+
+def detect(img, profile=None):
     """Return list of faces detected in a numpy array"""
+    profile = profile or profiles["default"]
     img = cv.fromarray(img)
+    min_size = (profile["min_size"], profile["min_size"])
     rects = []
-    for cascade in cascades:
-        options = (img, cascade, cv.CreateMemStorage(0), 1.3, 4, 0, (20, 20))
+    for name in profile["cascades"]:
+        options = (img, get_cascade(name), cv.CreateMemStorage(0),
+                   profile["scale_factor"], profile["min_neighbours"], 0,
+                   min_size)
         rects = cv.HaarDetectObjects(*options)
         if rects:
             return rects
@@ -0,0 +1,32 @@
+"""Copy frames from an RGB32 Avisynth clip into numpy arrays.
+
+This only needs the clip's frame buffer, so anything with the same
+attributes (_GetFrame, pBits, bmih.biWidth and Height) can stand in for an
+AvsClip, as the benchmarks do.
+"""
+import numpy
+
+from profiling import timings
+
+
+def get_numpy(avs, frame):
+    """Given a frame number, return a numpy array from the clip"""
+    with timings.stage("decode"):
+        avs._GetFrame(frame)
+    with timings.stage("convert"):
+        return frame_array(avs)
+
+
+def frame_array(avs):
+    """Copy the clip's current frame into a numpy array"""
+    end = avs.bmih.biWidth * avs.Height * 4
+    data = avs.pBits[:end]
+    # Somewhat fudgy way of turning avisynth pointers to numpy img
+    # Get pixel data into numpy array. It comes out bottom left to top right.
+    arrnew = numpy.array(data, dtype=numpy.uint8)
+    arrnew = numpy.flipud(arrnew)  # Reverse the data so it's ARGBARGB...
+    arrnew = arrnew.reshape(-1, 4)  # Array of [[A, R, G, B], ...]
+    arrnew = numpy.delete(arrnew, 0, 1)  # Remove the alpha channels
+    arrnew = arrnew.reshape(avs.Height, avs.bmih.biWidth, 3)
+    arrnew = numpy.fliplr(arrnew)
+    return arrnew
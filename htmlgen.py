@@ -0,0 +1,141 @@
+"""The html index: the template options made from a video's scene table.
+
+Kept apart from scenic.py, which only runs on Windows, so the benchmarks can
+render exactly what output_html does.
+"""
+import hashlib
+import json
+
+import numpy
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+from color import kelly_colours
+from tags import tag_bits, mask_tags, colour_tags, motion_tags, face_tags
+
+icon_key = {
+    "up": "Pan up",
+    "down": "Pan down",
+    "left": "Pan left",
+    "right": "Pan right",
+    "cw": "Clockwise rotation",
+    "ccw": "Counter-clockwise rotation",
+    "in": "Zoom in",
+    "out": "Zoom out",
+    "has_face": "Contains faces",
+    "no_face": "Does not contain faces",
+    "reset": "Reset all options",
+}
+
+# Shared jinja2 environment, created on first use by get_template
+template_env = None
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """Keys cached bytecode on the template's name only. jinja2 keys it on
+    the template's path as well, which is under a new temporary folder on
+    every frozen run. Bytecode for an edited template is still recompiled,
+    as jinja2 checks it against the source's checksum."""
+    def get_cache_key(self, name, filename=None):
+        return hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+
+def get_template(rpath, name):
+    """Return a compiled html template. Templates are compiled at most once
+    per process and their bytecode is cached on disk between runs."""
+    global template_env
+    if template_env is None:
+        template_env = Environment(loader=FileSystemLoader(rpath),
+                                   bytecode_cache=TemplateBytecodeCache(),
+                                   auto_reload=False)
+    return template_env.get_template(name)
+
+
+def scene_img_name(start, end, ext):
+    """File name of a scene's filmstrip."""
+    return "scene_%i_%i.%s" % (start, end, ext)
+
+
+def scene_rows(table, folder, vidpath, thumb_size, ext, colours=True):
+    """Yield a dictionary per scene for the html and xml exporters,
+    made from the scene table as they are needed. folder is the name of the
+    folder holding the filmstrips."""
+    names = colour_tags if colours else []
+    columns = zip(table.start.tolist(), table.end.tolist(),
+                  table.tags.tolist(), table.frames.tolist(),
+                  table.timestamps().tolist())
+    for i, (start, end, tags, frames, ts) in enumerate(columns):
+        title = "Scene %i, frames %i to %i,  %s" % (i, start, end, ts)
+        if names:
+            title += " with colours %s" % (", ".join(mask_tags(tags,
+                                                               names)))
+        yield {
+            "i": i,
+            "filename": "%s/%s" % (folder, scene_img_name(start, end, ext)),
+            "vidpath": vidpath,
+            "tags": tags,
+            "start": start,
+            "end": end,
+            "ts": ts,
+            "size": thumb_size,
+            "frames": frames,
+            "title": title,
+        }
+
+
+def scene_json(table):
+    """Compact scene data for the virtual html index. Each scene is
+    [start, end, timestamp, tag bitmask, filmstrip frames]"""
+    scenes = zip(table.start.tolist(), table.end.tolist(),
+                 table.timestamps().tolist(), table.tags.tolist(),
+                 table.frames.tolist())
+    return json.dumps(list(scenes), separators=(",", ":"))
+
+
+def html_options(table, folder, vidpath, vidfn, thumb_size, ext,
+                 colours=True, virtual=False):
+    """The template options for a video's html index. A virtual index only
+    creates elements for the scenes in view."""
+    k_colours = []
+    sort_colours = sorted(kelly_colours.items(), key=lambda t: t[1][2])
+    used_colours = table.used_tags(colour_tags)
+    for colour, items in sort_colours:
+        name = items[0]
+        k_colours.append((name, colour, name in used_colours))
+    if not colours:
+        k_colours = []
+
+    options = {
+        "img_data": scene_rows(table, folder, vidpath, thumb_size, ext,
+                               colours=colours),
+        "k_colours": k_colours,
+        "all_vectors": motion_tags + face_tags,
+        "used_vectors": table.used_tags(motion_tags + face_tags),
+        "dir": folder,
+        "vidfn": vidfn,
+        "thumb_height": thumb_size[1],
+        "icon_key": icon_key,
+        "tag_bits_json": json.dumps(tag_bits),
+    }
+    if virtual:
+        colour_names = [items[0] for colour, items in sort_colours]
+        if not colours:
+            colour_names = []
+        options.update({
+            "colour_names_json": json.dumps(colour_names),
+            "scenes_json": scene_json(table),
+            "thumb_size": thumb_size,
+            "frame_counts": numpy.unique(table.frames).tolist(),
+            "img_ext": ext,
+        })
+    else:
+        options["masks_json"] = json.dumps(table.tags.tolist(),
+                                           separators=(",", ":"))
+    return options
+
+
+def write_html(f, template, options):
+    """Stream the rendered page to an open file rather than building it in
+    memory."""
+    rendered = template.stream(options)
+    rendered.enable_buffering(size=100)
+    rendered.dump(f, encoding="utf-8")
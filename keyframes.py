@@ -0,0 +1,303 @@
+"""Read the keyframe tables stored in MP4/MOV and Matroska/WebM files.
+
+Only the container is read, nothing is decoded. read_keyframes returns a
+sorted list of frame numbers, or None if the file has no usable table (for
+example an intra-only codec where every frame is a keyframe).
+Frame numbers are in decode order for MP4 and are found from timestamps for
+Matroska, so they can be a frame or two out for streams with B-frames.
+"""
+import os
+import struct
+from bisect import bisect_left
+
+mp4_top_level = ["ftyp", "moov", "mdat", "free", "skip", "wide", "pdin",
+                 "uuid", "moof", "mfra", "meta"]
+
+ebml_magic = 0x1A45DFA3
+mkv_segment = 0x18538067
+mkv_info = 0x1549A966
+mkv_timecode_scale = 0x2AD7B1
+mkv_tracks = 0x1654AE6B
+mkv_track_entry = 0xAE
+mkv_track_number = 0xD7
+mkv_track_type = 0x83
+mkv_cues = 0x1C53BB6B
+mkv_cue_point = 0xBB
+mkv_cue_time = 0xB3
+mkv_cue_track_positions = 0xB7
+mkv_cue_track = 0xF7
+mkv_cluster = 0x1F43B675
+mkv_cluster_timecode = 0xE7
+mkv_simple_block = 0xA3
+mkv_block_group = 0xA0
+mkv_block = 0xA1
+mkv_reference_block = 0xFB
+mkv_top_level = [mkv_segment, mkv_info, mkv_tracks, mkv_cues, mkv_cluster,
+                 0x114D9B74, 0x1043A770, 0x1941A469, 0x1254C367]
+
+
+def read_keyframes(path, fps_num, fps_den):
+    """Return a sorted list of keyframe numbers for a video file, or None."""
+    with open(path, "rb") as f:
+        head = f.read(12)
+        f.seek(0)
+        if len(head) >= 4 and struct.unpack(">I", head[:4])[0] == ebml_magic:
+            return mkv_keyframes(f, fps_num, fps_den)
+        if len(head) >= 8 and head[4:8] in mp4_top_level:
+            return mp4_keyframes(f)
+    return None
+
+
+def snap_frame(frame, keyframes, start, end, tolerance):
+    """Return the keyframe nearest to frame if it is within tolerance frames
+    and inside the scene start to end, otherwise frame itself."""
+    if not keyframes or not tolerance:
+        return frame
+    i = bisect_left(keyframes, frame)
+    best = frame
+    best_distance = tolerance + 1
+    for k in keyframes[max(i - 1, 0):i + 1]:
+        distance = abs(k - frame)
+        if start <= k <= end and distance < best_distance:
+            best, best_distance = k, distance
+    return best
+
+
+# MP4 / MOV
+
+def mp4_boxes(f, start, end):
+    """Yield (type, data start, data end) for each box between two offsets."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header)
+        data = pos + 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            data += 8
+        elif size == 0:
+            size = end - pos
+        if size < data - pos:
+            return
+        yield kind, data, pos + size
+        pos += size
+
+
+def mp4_find(f, start, end, path):
+    """Yield (data start, data end) of every box matching a list of types."""
+    for kind, data, box_end in mp4_boxes(f, start, end):
+        if kind != path[0]:
+            continue
+        if len(path) == 1:
+            yield data, box_end
+        else:
+            for found in mp4_find(f, data, box_end, path[1:]):
+                yield found
+
+
+def mp4_keyframes(f):
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    for trak, trak_end in mp4_find(f, 0, size, ["moov", "trak"]):
+        handler = None
+        for data, box_end in mp4_find(f, trak, trak_end, ["mdia", "hdlr"]):
+            # version/flags, pre_defined, then the handler type
+            f.seek(data + 8)
+            handler = f.read(4)
+        if handler != "vide":
+            continue
+        stss = list(mp4_find(f, trak, trak_end,
+                             ["mdia", "minf", "stbl", "stss"]))
+        if not stss:
+            # No sync sample table means every sample is a keyframe
+            return None
+        data, box_end = stss[0]
+        f.seek(data + 4)
+        count = struct.unpack(">I", f.read(4))[0]
+        count = min(count, (box_end - data - 8) // 4)
+        samples = struct.unpack(">%iI" % count, f.read(4 * count))
+        # Sample numbers start at 1
+        return sorted(n - 1 for n in samples)
+    return None
+
+
+# Matroska / WebM
+
+def ebml_vint(f, keep_marker=False):
+    """Read an EBML variable length integer. Returns (value, length), with
+    value None for the reserved 'unknown size'."""
+    first = f.read(1)
+    if not first:
+        raise EOFError()
+    first = ord(first)
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML integer")
+    value = first if keep_marker else first & (mask - 1)
+    all_ones = (first & (mask - 1)) == mask - 1
+    for byte in f.read(length - 1):
+        value = (value << 8) | ord(byte)
+        all_ones = all_ones and ord(byte) == 0xFF
+    if all_ones and not keep_marker:
+        return None, length
+    return value, length
+
+
+def ebml_header(f, pos):
+    """Return (id, size, data start) of the element at pos."""
+    f.seek(pos)
+    eid, id_length = ebml_vint(f, keep_marker=True)
+    size, size_length = ebml_vint(f)
+    return eid, size, pos + id_length + size_length
+
+
+def ebml_elements(f, start, end):
+    """Yield (id, data start, data end) for the elements between two
+    offsets."""
+    pos = start
+    while pos < end:
+        try:
+            eid, size, data = ebml_header(f, pos)
+        except (EOFError, ValueError):
+            return
+        if size is None:
+            data_end = unknown_size_end(f, data, end)
+        else:
+            data_end = min(data + size, end)
+        yield eid, data, data_end
+        pos = data_end
+
+
+def unknown_size_end(f, start, end):
+    """Elements of unknown size (live streams write clusters this way) end
+    where the next top level element starts."""
+    pos = start
+    while pos < end:
+        try:
+            eid, size, data = ebml_header(f, pos)
+        except (EOFError, ValueError):
+            return end
+        if eid in mkv_top_level or size is None:
+            return pos
+        pos = data + size
+    return end
+
+
+def ebml_uint(f, data, end):
+    f.seek(data)
+    value = 0
+    for byte in f.read(end - data):
+        value = (value << 8) | ord(byte)
+    return value
+
+
+def mkv_keyframes(f, fps_num, fps_den):
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    scale = 1000000  # Default timecode scale in nanoseconds
+    track = None
+    cue_times = []
+    clusters = []
+    for eid, data, end in ebml_elements(f, 0, size):
+        if eid != mkv_segment:
+            continue
+        for child, cdata, cend in ebml_elements(f, data, end):
+            if child == mkv_info:
+                for item, idata, iend in ebml_elements(f, cdata, cend):
+                    if item == mkv_timecode_scale:
+                        scale = ebml_uint(f, idata, iend)
+            elif child == mkv_tracks:
+                track = mkv_video_track(f, cdata, cend)
+            elif child == mkv_cues:
+                cue_times = mkv_cue_times(f, cdata, cend)
+            elif child == mkv_cluster:
+                clusters.append((cdata, cend))
+        break
+    if track is None:
+        return None
+    times = [t for cue_track, t in cue_times if cue_track == track]
+    if not times:
+        times = mkv_block_times(f, clusters, track)
+    if not times:
+        return None
+    frames = set()
+    for t in times:
+        frames.add(int(round(float(t) * scale * fps_num / (fps_den * 1e9))))
+    return sorted(frames)
+
+
+def mkv_video_track(f, start, end):
+    """Number of the first video track."""
+    for entry, data, entry_end in ebml_elements(f, start, end):
+        if entry != mkv_track_entry:
+            continue
+        number = kind = None
+        for item, idata, iend in ebml_elements(f, data, entry_end):
+            if item == mkv_track_number:
+                number = ebml_uint(f, idata, iend)
+            elif item == mkv_track_type:
+                kind = ebml_uint(f, idata, iend)
+        if kind == 1:
+            return number
+    return None
+
+
+def mkv_cue_times(f, start, end):
+    """Return a list of (track, time) for every cue point."""
+    cues = []
+    for point, data, point_end in ebml_elements(f, start, end):
+        if point != mkv_cue_point:
+            continue
+        time = None
+        tracks = []
+        for item, idata, iend in ebml_elements(f, data, point_end):
+            if item == mkv_cue_time:
+                time = ebml_uint(f, idata, iend)
+            elif item == mkv_cue_track_positions:
+                for pos, pdata, pend in ebml_elements(f, idata, iend):
+                    if pos == mkv_cue_track:
+                        tracks.append(ebml_uint(f, pdata, pend))
+        if time is not None:
+            cues.extend((track, time) for track in tracks)
+    return cues
+
+
+def mkv_block_header(f, data):
+    """Return (track, relative timecode, flags) of a Block/SimpleBlock."""
+    f.seek(data)
+    track, length = ebml_vint(f)
+    timecode, flags = struct.unpack(">hB", f.read(3))
+    return track, timecode, flags
+
+
+def mkv_block_times(f, clusters, track):
+    """Scan every cluster for keyframe blocks of a track. Only used when the
+    file has no cues as it reads the header of every block."""
+    times = []
+    for start, end in clusters:
+        cluster_time = 0
+        for item, data, item_end in ebml_elements(f, start, end):
+            if item == mkv_cluster_timecode:
+                cluster_time = ebml_uint(f, data, item_end)
+            elif item == mkv_simple_block:
+                number, timecode, flags = mkv_block_header(f, data)
+                if number == track and flags & 0x80:
+                    times.append(cluster_time + timecode)
+            elif item == mkv_block_group:
+                block = None
+                referenced = False
+                for part, pdata, pend in ebml_elements(f, data, item_end):
+                    if part == mkv_block:
+                        block = mkv_block_header(f, pdata)
+                    elif part == mkv_reference_block:
+                        referenced = True
+                if block and block[0] == track and not referenced:
+                    times.append(cluster_time + block[1])
+    return times
@@ -0,0 +1,106 @@
+import json
+import os
+
+from mediainfo.MediaInfoDLL import MediaInfo, Stream
+MI = MediaInfo()
+Version = MI.Option_Static("Info_Version",
+                            "0.7.7.0;MediaInfoDLL_Example_Python;0.7.7.0")
+if Version == "":
+    print "\nMediaInfo.Dll: this version of the DLL is not compatible"
+
+# Bump this whenever the fields stored in a metadata record change
+version = 2
+
+
+def cache_dir():
+    """Per-user folder for caches shared between videos."""
+    root = os.environ.get("APPDATA") or os.path.expanduser("~")
+    path = os.path.join(root, "Scenic")
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def source_key(record):
+    """Videos with the same extension, container and codec can be opened
+    with the same Avisynth source method."""
+    ext = os.path.splitext(record["vidpath"])[1].lower()
+    return "%s|%s|%s" % (ext, record.get("container"), record.get("codec"))
+
+
+def load_source_methods():
+    """Return a dictionary of source_key: name of a working source method."""
+    path = os.path.join(cache_dir(), "sources.json")
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_source_method(record, method):
+    """Remember that a source method opened this kind of video."""
+    methods = load_source_methods()
+    key = source_key(record)
+    if methods.get(key) == method:
+        return
+    methods[key] = method
+    with open(os.path.join(cache_dir(), "sources.json"), "w") as f:
+        json.dump(methods, f, indent=1, sort_keys=True)
+
+
+def file_stamp(vidpath):
+    """Size and modification time used to tell if a video has changed."""
+    stat = os.stat(vidpath)
+    return {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+
+def read_mediainfo(vidpath):
+    """Read the container, codec and audio properties of a video file.
+    Uses its own MediaInfo handle so files can be read concurrently."""
+    mi = MediaInfo()
+    mi.Open(vidpath)
+    info = {
+        "container": mi.Get(Stream.General, 0, u"Format"),
+        "codec": mi.Get(Stream.Video, 0, u"Format"),
+        "frame_rate": mi.Get(Stream.Video, 0, u"FrameRate"),
+        "audio_depth": mi.Get(Stream.Audio, 0, u"Resolution"),
+        "audio_rate": mi.Get(Stream.Audio, 0, u"SamplingRate"),
+        "audio_channels": mi.Get(Stream.Audio, 0, u"Channels"),
+    }
+    mi.Close()
+    return info
+
+
+def new_record(vidpath):
+    """Start a metadata record for a video: everything MediaInfo knows,
+    ready for the Avisynth properties to be added by the prober."""
+    record = {"version": version, "vidpath": vidpath}
+    record.update(file_stamp(vidpath))
+    record.update(read_mediainfo(vidpath))
+    return record
+
+
+def load(path, vidpath):
+    """Return the cached metadata record at path, or None if there isn't
+    one or the video has changed since it was written."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            record = json.load(f)
+    except ValueError:
+        return None
+    if record.get("version") != version:
+        return None
+    stamp = file_stamp(vidpath)
+    if any(record.get(key) != value for key, value in stamp.items()):
+        return None
+    return record
+
+
+def save(path, record):
+    with open(path, "w") as f:
+        json.dump(record, f, indent=1, sort_keys=True)
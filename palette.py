@@ -0,0 +1,93 @@
+"""Colour palettes of scenes for finding scenes that look alike.
+
+A palette is a 64 bin histogram of a scene's pixels in Lab colour space
+(4 lightness x 4 a x 4 b bins). The square roots of the bin shares are
+stored as bytes, so the euclidean distance between two palettes is the
+Hellinger distance between their histograms.
+
+Palettes are searched with an inverted file index: k-means centroids split
+the palettes into lists and a search only compares against the lists whose
+centroids are nearest.
+"""
+import numpy
+
+l_edges = [25., 50., 75.]
+ab_edges = [-20., 0., 20.]
+bins = (len(l_edges) + 1) * (len(ab_edges) + 1) ** 2
+
+# sRGB to XYZ for a D65 white point
+rgb_to_xyz = numpy.array([[0.4124, 0.3576, 0.1805],
+                          [0.2126, 0.7152, 0.0722],
+                          [0.0193, 0.1192, 0.9505]])
+white = numpy.array([0.95047, 1., 1.08883])
+
+
+def rgb_to_lab(rgb):
+    """Convert an array of 8 bit RGB values, shape (..., 3), to Lab."""
+    rgb = numpy.asarray(rgb, dtype=numpy.float64) / 255.
+    linear = numpy.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4,
+                         rgb / 12.92)
+    xyz = linear.dot(rgb_to_xyz.T) / white
+    f = numpy.where(xyz > 0.008856, xyz ** (1 / 3.), 7.787 * xyz + 16 / 116.)
+    l = 116. * f[..., 1] - 16.
+    a = 500. * (f[..., 0] - f[..., 1])
+    b = 200. * (f[..., 1] - f[..., 2])
+    return numpy.dstack([l, a, b]).reshape(rgb.shape)
+
+
+def histogram(rgb):
+    """Return the palette of an RGB image, or of a list of colours, as a
+    numpy array of bins bytes."""
+    lab = rgb_to_lab(rgb).reshape(-1, 3)
+    side = len(ab_edges) + 1
+    index = (numpy.digitize(lab[:, 0], l_edges) * side * side +
+             numpy.digitize(lab[:, 1], ab_edges) * side +
+             numpy.digitize(lab[:, 2], ab_edges))
+    counts = numpy.bincount(index, minlength=bins).astype(numpy.float64)
+    shares = numpy.sqrt(counts / max(counts.sum(), 1))
+    return numpy.round(shares * 255).astype(numpy.uint8)
+
+
+def distances(query, vectors):
+    """Euclidean distances from one palette to an array of them."""
+    diff = vectors.astype(numpy.float32) - numpy.asarray(query, numpy.float32)
+    return numpy.sqrt((diff * diff).sum(axis=1))
+
+
+def nearest(vectors, centroids, batch=65536):
+    """Return the index of the nearest centroid for each vector."""
+    centroids = centroids.astype(numpy.float32)
+    norms = (centroids * centroids).sum(axis=1)
+    found = numpy.empty(len(vectors), dtype=numpy.int64)
+    for start in range(0, len(vectors), batch):
+        chunk = vectors[start:start + batch].astype(numpy.float32)
+        # |v - c|^2 less the |v|^2 term, which is the same for every c
+        scores = norms - 2 * chunk.dot(centroids.T)
+        found[start:start + batch] = scores.argmin(axis=1)
+    return found
+
+
+def kmeans(vectors, k, iterations=10, sample=16384, seed=0):
+    """Return k centroids for an array of palettes, trained on a random
+    sample of them."""
+    random = numpy.random.RandomState(seed)
+    if len(vectors) > sample:
+        vectors = vectors[random.choice(len(vectors), sample, replace=False)]
+    vectors = vectors.astype(numpy.float32)
+    k = min(k, len(vectors))
+    centroids = vectors[random.choice(len(vectors), k, replace=False)]
+    for i in range(iterations):
+        labels = nearest(vectors, centroids)
+        counts = numpy.bincount(labels, minlength=k)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, labels, vectors)
+        empty = counts == 0
+        centroids = sums / numpy.maximum(counts, 1)[:, numpy.newaxis]
+        # Restart empty clusters from random palettes
+        centroids[empty] = vectors[random.choice(len(vectors), empty.sum())]
+    return centroids
+
+
+def list_count(palettes):
+    """Number of inverted lists to train for a number of palettes."""
+    return max(1, min(256, int(palettes ** 0.5)))
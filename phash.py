@@ -0,0 +1,121 @@
+"""Perceptual hashes of frames, for finding repeated footage.
+
+A frame's hash is 64 bits from the signs of the lowest frequencies of a
+32x32 DCT of its brightness, so re-encodes, resizes and small colour changes
+give hashes only a few bits apart.
+
+Hashes are indexed by their four 16 bit chunks. If two hashes differ in at
+most 7 bits, one of the chunks differs in at most 1 bit, so a search only
+has to look up each chunk and its 16 one-bit neighbours.
+"""
+from math import sqrt
+
+import numpy
+
+size = 32  # The frame is shrunk to size x size
+low = 8  # Frequencies kept in each direction
+chunk_bits = 16
+chunk_count = 4
+chunk_mask = (1 << chunk_bits) - 1
+max_distance = 7
+# Frames are always hashed at this height, whatever the other stages use, so
+# hashes from runs with different options can be compared. It matches the
+# default colour height so that stage's frames are shared.
+frame_height = 96
+
+
+def dct_matrix(n):
+    """Orthonormal DCT-II matrix for n samples."""
+    k = numpy.arange(n)[:, numpy.newaxis]
+    i = numpy.arange(n)[numpy.newaxis, :]
+    matrix = numpy.cos(numpy.pi * (2 * i + 1) * k / (2. * n)) * sqrt(2. / n)
+    matrix[0] /= sqrt(2)
+    return matrix
+
+dct = dct_matrix(size)
+luma = numpy.array([0.299, 0.587, 0.114])
+
+
+def shrink(grey):
+    """Average a 2D array down to size x size."""
+    for axis in (0, 1):
+        length = grey.shape[axis]
+        edges = numpy.arange(size) * length // size
+        counts = numpy.diff(numpy.append(edges, length)).clip(1)
+        grey = numpy.add.reduceat(grey, edges, axis=axis)
+        if axis == 0:
+            grey /= counts[:, numpy.newaxis]
+        else:
+            grey /= counts
+    return grey
+
+
+def phash(array):
+    """Return the 64 bit perceptual hash of an RGB frame as an integer."""
+    grey = numpy.dot(array[..., :3].astype(numpy.float64), luma)
+    coeffs = dct.dot(shrink(grey)).dot(dct.T)[:low, :low].ravel()
+    # The DC term is only the average brightness
+    bits = coeffs > numpy.median(coeffs[1:])
+    return int(numpy.packbits(bits).view(">u8")[0])
+
+
+def distance(a, b):
+    """Number of bits that differ between two hashes."""
+    return bin(a ^ b).count("1")
+
+
+def chunks(value):
+    """Split a hash into its index chunks."""
+    return [(value >> (chunk_bits * i)) & chunk_mask
+            for i in range(chunk_count)]
+
+
+def probes(chunk, max_bits):
+    """Chunk values to look up to find every hash within max_bits."""
+    values = [chunk]
+    if max_bits >= chunk_count:
+        values.extend(chunk ^ (1 << bit) for bit in range(chunk_bits))
+    return values
+
+
+def signed(value):
+    """SQLite integers are signed 64 bit."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class MultiIndex(object):
+    """An in-memory index of hashes for finding all the near-duplicates
+    in a large set.
+       Usage: index = MultiIndex()
+              index.add("a", phash(frame))
+              index.search(phash(other), 4)
+       """
+
+    def __init__(self):
+        self.hashes = {}
+        self.tables = [{} for i in range(chunk_count)]
+
+    def add(self, key, value):
+        self.hashes[key] = value
+        for table, chunk in zip(self.tables, chunks(value)):
+            table.setdefault(chunk, []).append(key)
+
+    def search(self, value, max_bits):
+        """Return a list of (distance, key) within max_bits, nearest first."""
+        if max_bits > max_distance:
+            raise ValueError("Hashes can be searched up to %i bits apart"
+                             % max_distance)
+        candidates = set()
+        for table, chunk in zip(self.tables, chunks(value)):
+            for probe in probes(chunk, max_bits):
+                candidates.update(table.get(probe, ()))
+        found = []
+        for key in candidates:
+            bits = distance(value, self.hashes[key])
+            if bits <= max_bits:
+                found.append((bits, key))
+        return sorted(found)
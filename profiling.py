@@ -0,0 +1,127 @@
+"""Timings of each stage of the analysis, for finding where the time goes.
+
+Every process has its own Timings, which records how long each call of a
+stage took. Phase two workers send theirs back when they finish and the main
+process merges them, so a report covers the whole video: how many times each
+stage ran, its total time and the spread of its calls.
+
+Workers can also run cProfile on a sample of their scenes. Their stats are
+merged into the report as the functions with the most time of their own.
+"""
+import json
+import os
+import pstats
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+
+import numpy
+
+percentiles = [50, 90, 99]
+# Functions listed from the merged cProfile stats
+profile_top = 40
+
+
+class Timings(object):
+    """Durations in seconds of every call of each named stage. Does nothing
+    unless enabled, so the stages can stay in the code.
+       Usage: timings = Timings(enabled=True)
+              with timings.stage("decode"):
+                  get_frame()
+              timings.summary()
+       """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.samples = {}
+
+    def add(self, name, seconds):
+        # One list append, so writer threads can add without a lock
+        self.samples.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        started = default_timer()
+        try:
+            yield
+        finally:
+            self.add(name, default_timer() - started)
+
+    def merge(self, other):
+        """Add the calls recorded by another Timings, e.g. a worker's."""
+        for name, seconds in other.samples.items():
+            self.samples.setdefault(name, []).extend(seconds)
+
+    def clear(self):
+        self.samples = {}
+
+    def summary(self):
+        """Return a dictionary of stage name: count, total, mean, max and
+        percentiles of its calls in seconds."""
+        stages = {}
+        for name, seconds in self.samples.items():
+            values = numpy.array(seconds, dtype=numpy.float64)
+            stage = {
+                "count": len(values),
+                "total": float(values.sum()),
+                "mean": float(values.mean()),
+                "max": float(values.max()),
+            }
+            for p, value in zip(percentiles,
+                                numpy.percentile(values, percentiles)):
+                stage["p%i" % p] = float(value)
+            stages[name] = stage
+        return stages
+
+
+# Each process, including every phase two worker, has its own timings
+timings = Timings()
+
+
+def timed(name):
+    """Decorate a function to time each call as a stage of this process's
+    timings."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwds):
+            with timings.stage(name):
+                return func(*args, **kwds)
+        return wrapper
+    return decorator
+
+
+def dump_profile(profiler, folder):
+    """Save a worker's cProfile stats to folder, returning the path."""
+    path = os.path.join(folder, "profile_%i.prof" % os.getpid())
+    profiler.dump_stats(path)
+    return path
+
+
+def merge_profiles(paths, output):
+    """Merge the workers' cProfile stats into one file at output, which
+    pstats or snakeviz can open, and delete theirs. Returns a list of the
+    functions with the most time of their own."""
+    stats = pstats.Stats(*paths)
+    stats.dump_stats(output)
+    for path in paths:
+        os.remove(path)
+    rows = []
+    for (filename, line, func), row in stats.stats.items():
+        calls, total_calls, own, cumulative = row[:4]
+        rows.append({
+            "function": "%s:%i(%s)" % (os.path.basename(filename), line,
+                                       func),
+            "calls": total_calls,
+            "own": own,
+            "cumulative": cumulative,
+        })
+    rows.sort(key=lambda row: row["own"], reverse=True)
+    return rows[:profile_top]
+
+
+def write_report(path, report):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
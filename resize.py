@@ -0,0 +1,37 @@
+"""Frame sizes for each analysis stage.
+
+Avisynth resizes the video once, to the largest size any stage needs, and
+ResizeStage scales each frame down to every other size only once, however
+many stages share it.
+"""
+import numpy
+from PIL import Image
+
+
+def scaled_size(height, width, source_height):
+    """Size of a frame height pixels high with the aspect ratio of the
+    source, its width rounded down to a multiple of 8."""
+    return (8 * int((height * width / source_height) / 8), height)
+
+
+class ResizeStage(object):
+    """Resize frames for a dictionary of stage name: (width, height)."""
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def largest(self):
+        """The size Avisynth should output."""
+        return max(self.sizes.values(), key=lambda size: size[1])
+
+    def __call__(self, array):
+        """Return a dictionary of stage name: the frame at that stage's
+        size, given a frame at the largest size."""
+        made = {(array.shape[1], array.shape[0]): array}
+        frames = {}
+        for name, size in self.sizes.items():
+            if size not in made:
+                img = Image.fromarray(array).resize(size, Image.BILINEAR)
+                made[size] = numpy.asarray(img)
+            frames[name] = made[size]
+        return frames
@@ -0,0 +1,76 @@
+"""Save and load a video's analysis results as one binary file.
+
+The file is:
+
+    magic        8 bytes, "SCNRES\\r\\n"
+    header size  little endian uint32
+    header       JSON: the format version, any metadata and, for each
+                 column, its name, numpy dtype, shape and offset
+    columns      raw arrays, each starting on a 64 byte boundary
+
+Columns are read through a memory map so loading is almost instant and only
+the parts that are used are read from disk.
+"""
+import json
+import struct
+
+import numpy
+
+magic = "SCNRES\r\n"
+version = 1
+align = 64
+
+
+def padding(size):
+    return -size % align
+
+
+def save(path, meta, columns):
+    """Write a dictionary of metadata and a dictionary of name: numpy array
+    to path."""
+    layout = []
+    offset = 0
+    arrays = []
+    for name in sorted(columns):
+        array = numpy.ascontiguousarray(columns[name])
+        layout.append({"name": name,
+                       "dtype": array.dtype.str,
+                       "shape": list(array.shape),
+                       "offset": offset})
+        arrays.append(array)
+        offset += array.nbytes + padding(array.nbytes)
+    header = json.dumps({"version": version, "meta": meta, "columns": layout},
+                        separators=(",", ":"))
+    with open(path, "wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(" " * padding(len(magic) + 4 + len(header)))
+        for array in arrays:
+            array.tofile(f)
+            f.write("\0" * padding(array.nbytes))
+
+
+def load(path):
+    """Return (meta, columns) from a results file. The column arrays are
+    read-only views of a memory map of the file."""
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("%s is not a Scenic results file" % path)
+        size = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(size))
+    if header.get("version") != version:
+        raise ValueError("%s was written by a different version of Scenic"
+                         % path)
+    start = len(magic) + 4 + size
+    start += padding(start)
+    data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+    columns = {}
+    for column in header["columns"]:
+        dtype = numpy.dtype(str(column["dtype"]))
+        shape = tuple(column["shape"])
+        offset = start + column["offset"]
+        nbytes = dtype.itemsize * int(numpy.prod(shape))
+        columns[column["name"]] = (data[offset:offset + nbytes]
+                                   .view(dtype).reshape(shape))
+    return header["meta"], columns
@@ -0,0 +1,59 @@
+"""Share a video's frame sample budget between its scenes.
+
+Each scene is weighted by its length and how much the camera moves in it,
+so long takes and busy scenes get more filmstrip frames than short cuts.
+"""
+import numpy
+
+
+def allocate(weights, budget, floors, caps):
+    """Split budget whole samples between items in proportion to weights,
+    giving item i at least floors[i] and at most caps[i].
+
+    Shares are found by scaling the weights until the clamped shares add up
+    to the budget, then rounded with the largest remainder method so the
+    total is exact."""
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    floors = numpy.asarray(floors, dtype=numpy.int64)
+    caps = numpy.maximum(numpy.asarray(caps, dtype=numpy.int64), floors)
+    if budget <= floors.sum():
+        return floors.tolist()
+    if budget >= caps.sum():
+        return caps.tolist()
+    if not weights.any():
+        weights = numpy.ones_like(weights)
+
+    def shares(scale):
+        return numpy.clip(weights * scale, floors, caps)
+
+    # The clamped total only grows with the scale, so bisect for the budget
+    low, high = 0., 1.
+    while shares(high).sum() < budget:
+        high *= 2
+    for i in range(64):
+        middle = (low + high) / 2
+        if shares(middle).sum() < budget:
+            low = middle
+        else:
+            high = middle
+    ideal = shares(high)
+
+    counts = numpy.floor(ideal).astype(numpy.int64)
+    leftover = int(budget - counts.sum())
+    if leftover > 0:
+        remainders = numpy.where(counts < caps, ideal - counts, -1.)
+        # Stable sort keeps ties in scene order
+        order = numpy.argsort(-remainders, kind="mergesort")[:leftover]
+        counts[order[remainders[order] >= 0]] += 1
+    return counts.tolist()
+
+
+def plan_samples(lengths, activity, budget, minimum, maximum):
+    """Return the number of frames to sample from each scene given arrays of
+    scene lengths and activity, the total movement in frame widths. No scene
+    gets more samples than it has frames."""
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    weights = lengths * (1. + numpy.asarray(activity, dtype=numpy.float64))
+    caps = numpy.minimum(maximum, lengths)
+    floors = numpy.minimum(minimum, caps)
+    return allocate(weights, budget, floors, caps)
@@ -0,0 +1,119 @@
+"""Columnar storage for a video's scenes.
+
+Every scene is a row across a few numpy arrays rather than a set of Python
+objects, so memory stays small and whole-video operations such as formatting
+timecodes run over all scenes at once.
+"""
+import numpy
+
+from palette import bins as palette_bins
+from tags import tag_bits, mask_tags
+
+
+def timecodes(seconds):
+    """Format an array of times in seconds as HH:MM:SS.CC strings."""
+    seconds = numpy.asarray(seconds, dtype=numpy.float64)
+    fields = [seconds // 3600, seconds // 60 % 60, seconds % 60,
+              100 * (seconds % 1)]
+    if len(seconds) and fields[0].max() >= 100:
+        # Too long for fixed width fields
+        return numpy.array(["%02i:%02i:%02i.%02i" % tuple(values)
+                            for values in zip(*fields)])
+    # Write the digits straight into a block of characters
+    chars = numpy.empty((len(seconds), 11), dtype=numpy.uint8)
+    chars[:, 2] = chars[:, 5] = ord(":")
+    chars[:, 8] = ord(".")
+    for column, field in zip((0, 3, 6, 9), fields):
+        value = field.astype(numpy.int64)
+        chars[:, column] = ord("0") + value // 10
+        chars[:, column + 1] = ord("0") + value % 10
+    return chars.view("S11").ravel()
+
+
+class SceneTable(object):
+    """The scenes of a video as numpy columns:
+
+    start, end - first and last frame of each scene
+    tags - a bitmask of the scene's colour, motion and face tags (tags.py)
+    activity - total camera movement in frame widths
+    frames - number of frames sampled for the filmstrip
+    phash - perceptual hash of the middle sample (phash.py), 0 if unknown
+    palette - colour palette of the samples (palette.py), zeros if unknown
+
+    Scenes are kept in frame order.
+       Usage: table = SceneTable([(0, 99), (100, 250)], 25, 1)
+              table.add_tags(table.index(100), tag_mask(["red"]))
+       """
+
+    column_names = ["start", "end", "tags", "activity", "frames", "phash",
+                    "palette"]
+
+    def __init__(self, scenes, fps_num, fps_den):
+        bounds = numpy.array(scenes, dtype=numpy.int64).reshape(-1, 2)
+        self.start = bounds[:, 0].copy()
+        self.end = bounds[:, 1].copy()
+        count = len(self.start)
+        self.tags = numpy.zeros(count, dtype=numpy.uint32)
+        self.activity = numpy.zeros(count, dtype=numpy.float64)
+        self.frames = numpy.zeros(count, dtype=numpy.int32)
+        self.phash = numpy.zeros(count, dtype=numpy.uint64)
+        self.palette = numpy.zeros((count, palette_bins), dtype=numpy.uint8)
+        self.fps_num = fps_num
+        self.fps_den = fps_den
+
+    @classmethod
+    def from_columns(cls, columns, fps_num, fps_den):
+        """Make a table from a dictionary of name: array, as returned by
+        columns(). The arrays are used as they are, without copying, and
+        any that are missing are left empty."""
+        table = cls(numpy.column_stack([columns["start"], columns["end"]]),
+                    fps_num, fps_den)
+        for name in cls.column_names:
+            if name in columns:
+                setattr(table, name, columns[name])
+        return table
+
+    def columns(self):
+        """Return a dictionary of column name: array."""
+        return dict((name, getattr(self, name)) for name in self.column_names)
+
+    def __len__(self):
+        return len(self.start)
+
+    def __iter__(self):
+        """Iterate over (start, end) frame pairs."""
+        return iter(zip(self.start.tolist(), self.end.tolist()))
+
+    def lengths(self):
+        return self.end - self.start + 1
+
+    def index(self, start):
+        """Row of the scene starting at a frame."""
+        return int(numpy.searchsorted(self.start, start))
+
+    def seconds(self, frames):
+        return frames * float(self.fps_den) / self.fps_num
+
+    def start_times(self):
+        return self.seconds(self.start)
+
+    def end_times(self):
+        return self.seconds(self.end)
+
+    def timestamps(self):
+        """Return "start - end" timecode strings for every scene."""
+        starts = timecodes(self.start_times())
+        ends = timecodes(self.end_times())
+        return numpy.char.add(numpy.char.add(starts, " - "), ends)
+
+    def add_tags(self, row, mask):
+        self.tags[row] |= mask
+
+    def has_tag(self, name):
+        """Return a boolean array of the scenes with a tag."""
+        return (self.tags & tag_bits[name]) != 0
+
+    def used_tags(self, names):
+        """Return the names of the tags set on at least one scene."""
+        used = int(numpy.bitwise_or.reduce(self.tags)) if len(self) else 0
+        return mask_tags(used, names)
@@ -2,6 +2,10 @@
 Pass in a file or a directory of files for analysis.
 
 Usage:
+  scenic.py query [--catalog=PATH] [--limit=N] <TAG>...
+  scenic.py dupes [--catalog=PATH] [--distance=N] [<PATH>...]
+  scenic.py similar [--catalog=PATH] [--limit=N] <VIDEO> <SCENE>
+  scenic.py similar [--catalog=PATH] [--limit=N] --palette=COLOURS
   scenic.py
   scenic.py [<PATH>...]
   scenic.py [--skip | --overwrite] [options] [<PATH>...]
@@ -12,16 +16,75 @@ Options:
   --skip        Skip file if .html file exists.
   --overwrite   Always overwrite any existing output files.
   --frames=N    Number of frames to sample per scene. [default: 4]
+  --budget=N    Total frames to sample from the video, shared between scenes
+                by length and movement. 0 samples --frames from every scene.
+                [default: 0]
+  --min-frames=N  Fewest frames sampled from a scene with --budget.
+                [default: 2]
+  --max-frames=N  Most frames sampled from a scene with --budget.
+                [default: 16]
   --minscene=N  Smallest allowed scene length in frames. [default: 10]
   --faces=N     Process 1 in N samples for face detection. [default: 1]
   --colours=N   Number of colours to detect per scene. [default: 6]
   --cpus=N      Number of logical processors to use. Uses all by default.
+  --height=N    Height of the filmstrip thumbnails in pixels. [default: 240]
+  --detect-height=N  Height in pixels for scene and motion detection.
+                [default: 240]
+  --colour-height=N  Height in pixels for colour analysis. [default: 96]
+  --face-height=N  Height in pixels for face detection. [default: 240]
+  --face-profile=NAME  Face detection cascades and parameters: a built in
+                profile or a JSON file from benchmarks/face_calibration.py.
+                A profile's own height replaces --face-height.
+                [default: default]
+  --format=EXT  Filmstrip image format, jpg or webp. [default: jpg]
+  --quality=N   Filmstrip image quality from 1 to 95. [default: 75]
+  --chroma=N    JPEG chroma subsampling: 0 (4:4:4), 1 (4:2:2) or 2 (4:2:0).
+                [default: 2]
+  --writers=N   Number of image writer threads per processor. [default: 2]
+  --baseline    Write baseline rather than progressive, optimised JPEGs.
+  --envs=N      Number of idle Avisynth environments to keep for reuse in
+                each process. 0 releases them after every script. [default: 1]
+  --memory=MB   Avisynth frame cache per process in MB. By default half the
+                free memory is shared between the processes.
+  --coarse=N    Find candidate cuts in a fast pass N pixels high, then run
+                full size detection only around them. 0 disables. [default: 0]
+  --snap=N      Move each sampled frame to a keyframe up to N frames away,
+                which is much faster to seek to. 0 disables. [default: 0]
   --silent      Silent mode. Use --skip or --overwrite to surpress dialogs.
   --no-colours  Do not tag scenes by colour.
   --no-motion   Disable motion Detection.
   --no-face     Disable scene face recognition.
+  --no-crop     Analyse the whole frame, including any black borders.
   --no-popups   Do not open generated html in the web browser.
   --no-xml      Do not generate the FCP .xml file.
+  --rebuild     Write the html and xml again from the saved results without
+                opening the video. Replaces them without asking, even with
+                --skip.
+  --virtual     Write an html index that only loads the scenes in view.
+                Recommended for long videos with thousands of scenes.
+  --catalog=PATH  SQLite catalog of every analysed scene. Defaults to
+                catalog.sqlite in the Scenic settings folder.
+  --no-catalog  Do not add the scenes to the catalog.
+  --limit=N     Most scenes listed by query or similar, 0 for all.
+                [default: 100]
+  --palette=COLOURS  Comma separated colours to find similar scenes to, as
+                #RRGGBB hex or Kelly colour names such as vivid_red.
+  --match=N     Copy the colour and face tags of a scene from another
+                catalogued video whose perceptual hash is up to N bits (at most
+                7) from one of this scene's samples, rather than analyse it
+                again. Only videos that were checked for the same tags are
+                used. [default: 0]
+  --profile-report=PATH  Time each stage of the analysis and write the
+                counts, totals and percentiles to a JSON file. With several
+                videos each report is named after its video.
+  --profile-every=N  With --profile-report, also run cProfile on 1 in N
+                scenes in each worker and add the slowest functions to the
+                report. 0 disables. [default: 0]
+  --events=TARGET  Write progress and throughput events as JSON lines to a
+                file, or to a file descriptor as fd:N. fd:1 is the console,
+                even with --silent.
+  --distance=N  Most bits apart for dupes to call scenes repeats, at most 7.
+                [default: 4]
   --version     Show version.
   -h --help     Show this screen.
 
@@ -37,16 +100,21 @@ else:
     # we are running in a normal Python environment
     basedir = os.path.dirname(__file__)
 
+import cPickle
+import cProfile
+import copy
 import ctypes
 import ctypes.wintypes
 import re
 import shutil
+import struct
+import time
 import webbrowser
-from collections import defaultdict
 from functools import wraps
 from math import ceil
 from subprocess import check_output
 from multiprocessing import Queue, cpu_count, freeze_support, active_children
+from Queue import Empty
 
 # GUI
 import Tkinter
@@ -57,15 +125,37 @@ import tkFileDialog
 import numpy
 import progressbar as pb
 import face
-from PIL import Image
-from jinja2 import Template
 from docopt import docopt
 
 from avisynth.pyavs import AvsClip
 from avisynth import avisynth
-from color import get_colour_name, most_frequent_colours, kelly_colours
-from xmlgen import make_xml
+from color import kelly_colours
+from xmlgen import write_xml
+from htmlgen import (get_template, scene_img_name, scene_rows, html_options,
+                     write_html)
+import metadata
+import memory
+from encoder import ThumbnailEncoder, human_size
+from tags import tag_mask, colour_tags, face_tags
+from scenetable import SceneTable
+import results
+from catalog import Catalog
+from phash import (max_distance as phash_max_distance,
+                   frame_height as phash_frame_height)
+from palette import histogram
+from keyframes import read_keyframes, snap_frame
+from sampling import plan_samples
+from resize import ResizeStage, scaled_size
+from analysis import process_scene
+from crop import find_borders, crop_script
+from detection import (read_keyframe_flags, scenes_from_flags,
+                       candidate_windows, trim_script, map_window_flags,
+                       read_motion, tag_motion)
 from frozen_process import Process
+from frames import get_numpy
+from profiling import timings, timed, dump_profile, merge_profiles
+import profiling
+from events import stream, WorkerProgress
 
 
 version_string = ""
@@ -85,6 +175,22 @@ ctypes.windll.shell32.SHGetFolderPathW(0, 5, 0, 0, buf)
 my_documents = buf.value
 ctypes.windll.kernel32.SetConsoleTitleA(app_name)
 
+# Frames either side of a coarse candidate cut to check at full size
+coarse_pad = 12
+
+# Frames checked for black borders
+crop_samples = 8
+
+# Avisynth source methods, in the order they are tried. Metadata records only
+# keep the method and its parameters, e.g. {"method": "ffms2", "index": path},
+# and the script is rebuilt each run.
+source_scripts = [
+    ("avisource", 'AVISource("%(vidfn)s")'),
+    ("ffms2", 'LoadPlugin("%(rpath)s\\ffms2.dll")\n'
+              'FFVideoSource("%(vidfn)s", cachefile="%(index)s")'),
+    ("import", 'Import("%(vidfn)s")'),
+]
+
 valid_filetypes = [
     ".avi",
     ".avs",
@@ -103,41 +209,118 @@ valid_filetypes = [
 ]
 
 
-def mp_image_process(script, input, output):
+def mp_image_process(script, input, output, encoder_options, pool_size,
+                     memory_max, timing=False, profile_every=0,
+                     profile_dir=None, progress=False):
     """With a script string and two multiprocessing
     queues, will allow batch avs frame getting
-    operations spread across many cpus!"""
-    with AvisynthHelper(script) as clip:
-        for foo, start, end in iter(input.get, 'STOP'):
-            result = foo.process_images(clip, start, end)
-            output.put(result)
+    operations spread across many cpus!
+    Once told to STOP, reports ("DONE", stats) for this worker, or
+    ("ERROR", message) as soon as anything fails, e.g. a filmstrip write.
+    With timing the stats include the worker's timings, and with
+    profile_every 1 in that many scenes are run under cProfile, whose stats
+    are saved in profile_dir. With progress it also reports ("PROGRESS",
+    sample) every few seconds for the event stream."""
+    env_pool.size = pool_size
+    env_pool.memory_max = memory_max
+    timings.enabled = timing
+    timings.clear()
+    profiler = cProfile.Profile() if profile_every else None
+    counter = WorkerProgress() if progress else None
+    try:
+        with AvisynthHelper(script, pool=env_pool) as clip:
+            with ThumbnailEncoder(timings=timings,
+                                  **encoder_options) as encoder:
+                tasks = iter(input.get, 'STOP')
+                for i, (foo, start, end, frames) in enumerate(tasks):
+                    sampled = profiler and i % profile_every == 0
+                    if sampled:
+                        profiler.enable()
+                    with timings.stage("scene"):
+                        result = foo.process_images(clip, encoder, start,
+                                                    end, frames)
+                    if sampled:
+                        profiler.disable()
+                    output.put(result)
+                    sample = counter and counter.add(len(frames))
+                    if sample:
+                        output.put(("PROGRESS", sample))
+    except Exception as e:
+        # Tell the main process rather than leave it waiting for DONE
+        output.put(("ERROR", "%s: %s" % (type(e).__name__, e)))
+        return
+    env_pool.close()
+    for catalog in worker_catalogs.values():
+        catalog.close()
+    stats = {"bytes": encoder.bytes_written,
+             "peak_memory": memory.peak_memory()}
+    if timing:
+        stats["timings"] = timings
+    if profiler:
+        stats["profile"] = dump_profile(profiler, profile_dir)
+    output.put(("DONE", stats))
+
+
+def worker_message(queue, workers, poll=1.):
+    """Return the next message from the phase two workers. If a worker
+    reports an error or dies, every worker is stopped and an exception is
+    raised, so the video fails rather than waiting for ever."""
+    while True:
+        try:
+            message = queue.get(timeout=poll)
+        except Empty:
+            codes = [worker.exitcode for worker in workers
+                     if worker.exitcode not in (None, 0)]
+            if not codes:
+                continue
+            error = "A phase two worker exited with code %s" % codes[0]
+        else:
+            if message[0] != "ERROR":
+                return message
+            error = "A phase two worker failed: %s" % message[1]
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        raise Exception(error)
+
+
+# Catalogs opened by this worker process, by path
+worker_catalogs = {}
+
+
+def get_worker_catalog(path):
+    """Open a catalog once per worker process."""
+    if path not in worker_catalogs:
+        worker_catalogs[path] = Catalog(path)
+    return worker_catalogs[path]
 
 
 def takespread(sequence, num):
     """Yield an even spread of items from a sequence"""
     if len(sequence) < num:
         for x in sequence:
-            yield sequence
+            yield x
     else:
         length = float(len(sequence))
         for i in range(num):
             yield sequence[int(ceil(i * length / num))]
 
 
-def get_numpy(avs, frame):
-        """Given a frame number, return a numpy array from the clip"""
-        avs._GetFrame(frame)
-        end = avs.bmih.biWidth * avs.Height * 4
-        data = avs.pBits[:end]
-        # Somewhat fudgy way of turning avisynth pointers to numpy img
-        # Get pixel data into numpy array. It comes out bottom left to top right.
-        arrnew = numpy.array(data, dtype=numpy.uint8)
-        arrnew = numpy.flipud(arrnew)  # Reverse the data so it's ARGBARGB...
-        arrnew = arrnew.reshape(-1, 4)  # Array of [[A, R, G, B], ...]
-        arrnew = numpy.delete(arrnew, 0, 1)  # Remove the alpha channels
-        arrnew = arrnew.reshape(avs.Height, avs.bmih.biWidth, 3)
-        arrnew = numpy.fliplr(arrnew)
-        return arrnew
+def pump_frames(clip, framecount, progress=None, batch=500, interval=0.5):
+    """Request every frame of a raw Avisynth clip in its native colourspace
+    and drop it straight away. This runs the filter chain (e.g. SCXvid and
+    MDepan logging) with as little Python work per frame as possible.
+    progress, if given, is called with the frame number at most once per
+    interval seconds."""
+    get_frame = clip.GetFrame
+    last = time.time()
+    for start in xrange(0, framecount, batch):
+        for frame in xrange(start, min(start + batch, framecount)):
+            get_frame(frame)
+        now = time.time()
+        if progress and now - last >= interval:
+            last = now
+            progress(min(start + batch, framecount))
 
 
 def is_ready(func):
@@ -150,22 +333,100 @@ def is_ready(func):
     return wrapper
 
 
+class EnvironmentPool(object):
+    """Keeps up to size idle Avisynth script environments warm so that
+    opening another script doesn't pay for environment setup again.
+    Environments are given a frame cache of memory_max MB when acquired."""
+    def __init__(self, size=1, memory_max=memory.min_cache):
+        super(EnvironmentPool, self).__init__()
+        self.size = size
+        self.memory_max = memory_max
+        self.idle = []
+
+    def acquire(self):
+        if self.idle:
+            env = self.idle.pop()
+        else:
+            env = avisynth.avs_create_script_environment(1)
+        env.SetMemoryMax(self.memory_max)
+        return env
+
+    def release(self, env):
+        if len(self.idle) < self.size:
+            self.idle.append(env)
+        else:
+            env.Release()
+
+    def close(self):
+        """Release every idle environment."""
+        while self.idle:
+            self.idle.pop().Release()
+
+
+# Each process, including every phase two worker, has its own pool
+env_pool = EnvironmentPool()
+
+
 class AvisynthHelper(object):
-    """Avisynth helper class. Adds with support."""
-    def __init__(self, script):
+    """Avisynth helper class. Adds with support.
+    Gives an RGB32 AvsClip, or with raw the script's own PClip with no
+    colourspace conversion.
+    The clip and its script environment are released on exit, or the
+    environment is handed back to pool if one is given."""
+    def __init__(self, script, pool=None, memory_max=memory.min_cache,
+                 raw=False):
         super(AvisynthHelper, self).__init__()
         self.script = script
-        self.env = avisynth.avs_create_script_environment(1)
-        self.env.SetMemoryMax(8)
+        self.raw = raw
+        self.pool = pool
+        self.r = None
+        self.clip = None
+        if pool:
+            self.env = pool.acquire()
+        else:
+            self.env = avisynth.avs_create_script_environment(1)
+            self.env.SetMemoryMax(memory_max)
 
     def __enter__(self):
-        self.r = self.env.Invoke("eval", avisynth.AVS_Value(self.script), 0)
-        self.clip = AvsClip(self.r.AsClip(self.env), env=self.env)
+        try:
+            self.r = self.env.Invoke("eval",
+                                     avisynth.AVS_Value(self.script), 0)
+            if self.raw:
+                self.clip = self.r.AsClip(self.env)
+            else:
+                self.clip = AvsClip(self.r.AsClip(self.env), env=self.env)
+        except:
+            self.release()
+            raise
         return self.clip
 
     def __exit__(self, t, value, traceback):
-        if not t:
-            return True
+        self.release()
+
+    def release(self):
+        """Release the clip before the environment that created it."""
+        if self.clip is not None:
+            if self.raw:
+                self.clip.Release()
+            else:
+                if self.clip.initialized and self.clip.clip is not None:
+                    self.clip.clip.Release()
+                self.clip.clip = None
+                self.clip.initialized = False
+            self.clip = None
+        if self.r is not None:
+            self.r.Release()
+            self.r = None
+        if self.env is not None:
+            if self.pool:
+                # Drop the script's last clip before reuse. Any variable the
+                # script set itself stays alive, so scripts binding their
+                # own variables mustn't be given a pool.
+                self.env.SetVar("last", avisynth.AVS_Value())
+                self.pool.release(self.env)
+            else:
+                self.env.Release()
+            self.env = None
 
 
 class Analyser(object):
@@ -176,19 +437,55 @@ class Analyser(object):
 
     def __init__(self, vidpath, skip=False, overwrite=False, frames=4,
                  min_slength=10, faceprec=1, num_colours=6, nocol=False,
-                 nomo=False, noface=False, cpus=0):
+                 nomo=False, noface=False, cpus=0, thumb_height=240,
+                 thumb_format="jpg", quality=75, subsampling=2, writers=2,
+                 progressive=True, envs=1, memory_max=0, coarse_height=0,
+                 snap=0, budget=0, min_frames=2, max_frames=16,
+                 detect_height=240, colour_height=96, face_height=240,
+                 nocrop=False, catalog_path=None, rebuild=False,
+                 match_bits=0, profile_report=None, profile_every=0,
+                 face_profile=None):
         if not vidpath:
             raise Exception("Analyser must have a vid path.")
         self.vidpath = vidpath
         self.skip = skip  # Whether we should skip already-processed files
         self.overwrite = overwrite  # Whether we should overwrite files
         self.samplesize = frames
+        self.budget = budget  # Total samples for the video, 0 for fixed
+        self.min_frames = min_frames
+        self.max_frames = max_frames
         self.min_slength = min_slength
         self.num_colours = num_colours  # Number of colours to detect
         self.faceprec = faceprec  # Proces 1 in N frames for facial recognition
         self.nocol = nocol  # Disables colour matching
         self.nomo = nomo    # Disables motion analysis
         self.noface = noface  # Disables face recognition
+        self.nocrop = nocrop  # Disables cropping black borders
+        self.catalog_path = catalog_path  # Scene catalog, None disables
+        self.match_bits = match_bits  # Hash distance to reuse tags, 0 for off
+        self.profile_report = profile_report  # Timings JSON, None for off
+        self.profile_every = profile_every  # cProfile 1 in N worker scenes
+        timings.enabled = bool(profile_report)
+        timings.clear()
+        self.thumb_height = thumb_height  # Height of filmstrip frames
+        self.detect_height = detect_height  # Height for SCXvid and MDepan
+        self.colour_height = colour_height  # Height for colour analysis
+        self.face_profile = face_profile or face.profiles["default"]
+        # Height for face detection
+        self.face_height = self.face_profile["height"] or face_height
+        self.encoder_options = {
+            "fmt": thumb_format,
+            "quality": quality,
+            "subsampling": subsampling,
+            "progressive": progressive,
+            "threads": writers,
+        }
+        self.envs = envs  # Warm Avisynth environments to keep per process
+        env_pool.size = envs
+        self.memory_max = memory_max  # Avisynth cache in MB, 0 for auto
+        self.coarse_height = coarse_height  # 0 disables coarse detection
+        self.snap = snap  # Keyframe snapping distance in frames
+        self.keyframes = None  # Sorted keyframe numbers from the container
         self.rpath = os.path.realpath(os.path.join(basedir, "resources"))
         self.vidfn = os.path.split(vidpath)[1]
         self.vidname = os.path.splitext(self.vidfn)[0]
@@ -196,24 +493,63 @@ class Analyser(object):
         self.picpath = os.path.join(self.vidroot, "Scenes_%s" % self.vidname)
         self.htmlpath = os.path.join(self.vidroot, "%s.html" % self.vidname)
         self.xmlpath = os.path.join(self.vidroot, "%s.xml" % self.vidname)
-        self.vid_info = {}
-        self.source = self.open_video()
+        self.metapath = os.path.join(self.picpath, "metadata.json")
+        self.indexpath = os.path.join(self.picpath, "ffms2.ffindex")
+        self.resultspath = os.path.join(self.picpath, "results.scenic")
+        self.vid_info = {}  # The metadata record for the source video
+        self.source = ""  # Avisynth script to open the source video
+        self.thumb_size = (0, 0)
+        self.detect_size = (0, 0)  # Frame size during scene detection
+        self.resize_stage = None  # Frame sizes for each phase two stage
         self.cpus = cpu_count()
         if cpus:
             self.cpus = min(cpus, self.cpus)
 
         print "Processing video %s" % (self.vidfn)
 
-        self.scenes = []  # A list of (start, end) frames
-        self.times = {}  # A dictionary of frame: time in seconds
-        self.vectors = {}  # A dicitonary of start_frame: set(movements)
-        self.colours = {}  # A dicitonary of start_frame: set(colours)
-        self.all_vectors = set()  # A set of all possible movements
-        self.all_colours = set()  # A set of all possible colours
-        self.img_data = []  # A list of data for html/xml generation
+        self.table = None  # A SceneTable of the scenes and their tags
+        self.motion = None  # MDepan (x, y, rotation, zoom) for each frame
+        self.analysed = False  # Whether phase two has run
+        self.bytes_written = 0  # Size of all the filmstrips on disk
+        self.worker_peaks = []  # Peak memory of each phase two worker
+        self.worker_profiles = []  # Workers' cProfile stats files
         self.ready = False
 
+        if rebuild:
+            # Rebuilding only rewrites the html and xml from the saved
+            # results, so there is nothing to skip or ask about
+            self.ready = True
+            self.load_results()
+            return
         self.check_output_files()
+        if self.ready:
+            self.vid_info = self.open_video()
+            self.source = self.get_source()
+            self.thumb_size = self.get_thumb_size()
+            if self.snap:
+                self.keyframes = self.get_keyframes()
+
+    def __getstate__(self):
+        # The analyser is sent with every task; workers get their frame
+        # numbers ready made and return their tags, so they need neither
+        # the keyframes nor the whole video's scenes and motion.
+        state = self.__dict__.copy()
+        state["keyframes"] = None
+        state["table"] = None
+        state["motion"] = None
+        # The metadata record keeps the keyframes too
+        state["vid_info"] = dict((key, value) for key, value in
+                                 self.vid_info.items() if key != "keyframes")
+        return state
+
+    def task_size_fixed(self):
+        """Whether the analyser sent with each task is the same size however
+        many keyframes the video has."""
+        other = copy.copy(self)
+        other.keyframes = range(100000)
+        other.vid_info = dict(self.vid_info, keyframes=other.keyframes)
+        return (len(cPickle.dumps(other, 2)) ==
+                len(cPickle.dumps(self, 2)))
 
     def check_output_files(self):
         """Make directories if they do not exist already. Check to see if we
@@ -235,99 +571,258 @@ class Analyser(object):
                 print "Processing cancelled for %s." % self.vidfn
                 return
         # Safe to overwrite all files
+        self.ready = True
         if not os.path.exists(self.picpath):
             os.mkdir(self.picpath)
         return
 
     def open_video(self):
-        """Find a compatible Avisynth import method for the given file.
+        """Probe the video once and return its metadata record: the
+        MediaInfo properties, a compatible Avisynth import method and the
+        clip properties. The record is cached beside the scene images so
+        later runs can skip the probe entirely.
+        The source method that last worked for this container and codec is
+        tried first. FFMS2 keeps its index in the Scenes folder so that
+        the probe, detection and every worker share a single index scan.
             TODO: Add other sources? qtsource?
         """
-        sources = [
-            'AVISource("%(vidfn)s")',
-            'LoadPlugin("%(rpath)s\\ffms2.dll")\nFFVideoSource("%(vidfn)s")',
-            'Import("%(vidfn)s")',
-        ]
-
-        for source in sources:
+        record = metadata.load(self.metapath, self.vidpath)
+        if record:
+            return record
+        record = metadata.new_record(self.vidpath)
+        methods = [method for method, template in source_scripts]
+        # Probing only reads one frame's worth of properties
+        env_pool.memory_max = memory.min_cache
+        known = metadata.load_source_methods().get(metadata.source_key(record))
+        methods.sort(key=lambda method: method != known)
+
+        for method in methods:
+            source = {"method": method}
+            if method == "ffms2":
+                source["index"] = self.indexpath
             try:
-                script = source % {"vidfn": self.vidpath, "rpath": self.rpath}
-                with AvisynthHelper(script) as clip:
-                    self.get_vid_info(clip)
+                script = self.source_script(source)
+                with AvisynthHelper(script, pool=env_pool) as clip:
+                    record.update(self.get_vid_info(clip))
             except avisynth.AvisynthError as e:
                 if not __debug__:
                     print e
                     print "Trying alternate methods"
             else:
-                return script
+                record["source"] = source
+                metadata.save(self.metapath, record)
+                metadata.save_source_method(record, method)
+                return record
         raise Exception("Cannot open video file %s" % self.vidpath)
 
-    def get_vid_info(self, clip):
-        """Store important information about this avisynth clip"""
-        self.vid_info = {
-                        "framecount": int(clip.Framecount),
-                        "width": int(clip.Width),
-                        "height": int(clip.Height),
-                        "fps_num": int(clip.FramerateNumerator),
-                        "fps_den": int(clip.FramerateDenominator),
-                    }
+    def source_script(self, source):
+        """Avisynth script opening the video with a source method from the
+        metadata record. Plugins are loaded from this run's resources
+        folder, which is a new temporary folder on every frozen run."""
+        return dict(source_scripts)[source["method"]] % {
+            "vidfn": self.vidpath,
+            "rpath": self.rpath,
+            "index": source.get("index"),
+        }
 
-    @is_ready
-    def scene_detection(self):
-        """Use SCXvid to generate a list of scene keyframes.
-        Simlutaneously, using MDepan to log the motion vectors."""
+    def get_vid_info(self, clip):
+        """Return important information about this avisynth clip"""
+        return {
+                "framecount": int(clip.Framecount),
+                "width": int(clip.Width),
+                "height": int(clip.Height),
+                "fps_num": int(clip.FramerateNumerator),
+                "fps_den": int(clip.FramerateDenominator),
+            }
 
-        keylog = os.path.join(self.picpath, "keyframes.log")
-        mvlog = os.path.join(self.picpath, "vectors.log")
+    def get_borders(self):
+        """Return the black border (left, top, right, bottom) around the
+        picture, found once from a few frames and kept in the metadata
+        record."""
+        if "borders" not in self.vid_info:
+            framecount = self.vid_info["framecount"]
+            # Avoid the very start and end, which are often fades
+            frames = [int((i + 1) * framecount / (crop_samples + 1))
+                      for i in range(crop_samples)]
+            env_pool.memory_max = memory.min_cache
+            with AvisynthHelper(self.source_script(self.vid_info["source"]),
+                                pool=env_pool) as clip:
+                borders = find_borders(get_numpy(clip, frame)
+                                       for frame in frames)
+            self.vid_info["borders"] = list(borders)
+            metadata.save(self.metapath, self.vid_info)
+        return tuple(self.vid_info["borders"])
+
+    def get_source(self):
+        """Avisynth script opening the video for analysis, with any black
+        borders cropped off so no stage wastes time on them."""
+        source = self.source_script(self.vid_info["source"])
+        if not self.nocrop:
+            cropping = crop_script(self.get_borders())
+            if cropping:
+                source += "\n" + cropping
+        return source
+
+    def get_frame_size(self):
+        """Size of the analysed picture, after cropping."""
+        width, height = self.vid_info["width"], self.vid_info["height"]
+        if not self.nocrop:
+            left, top, right, bottom = self.get_borders()
+            width -= left + right
+            height -= top + bottom
+        return width, height
+
+    def get_keyframes(self):
+        """Return the keyframe numbers from the video's container, read
+        once and kept in the metadata record. None if they are unknown."""
+        if "keyframes" not in self.vid_info:
+            try:
+                frames = read_keyframes(self.vidpath, self.vid_info["fps_num"],
+                                        self.vid_info["fps_den"])
+            except (IOError, struct.error) as e:
+                print "Could not read keyframes: %s" % e
+                frames = None
+            self.vid_info["keyframes"] = frames
+            metadata.save(self.metapath, self.vid_info)
+        return self.vid_info["keyframes"]
+
+    def get_thumb_size(self):
+        """Size of each filmstrip frame, rounded the same way as the
+        BilinearResize in phase two."""
+        return self.get_stage_size(self.thumb_height)
+
+    def get_stage_size(self, height):
+        """Size of a frame height pixels high with the video's shape."""
+        width, source_height = self.get_frame_size()
+        return scaled_size(height, width, source_height)
+
+    def get_resize_stage(self):
+        """The frame size for each phase two stage that is switched on."""
+        sizes = {"thumb": self.thumb_size,
+                 "hash": self.get_stage_size(phash_frame_height)}
+        if not self.nocol:
+            sizes["colour"] = self.get_stage_size(self.colour_height)
+        if not self.noface:
+            sizes["face"] = self.get_stage_size(self.face_height)
+        return ResizeStage(sizes)
+
+    def detection_script(self, height, keylog, mvlog=None, trim=None):
+        """Avisynth script logging SCXvid keyframes, and optionally MDepan
+        motion vectors, for the source resized to height pixels. trim is an
+        optional expression selecting parts of the source."""
         script = (
             'LoadPlugin("%(rpath)s\\SCXvid.dll")\n'
             'LoadPlugin("%(rpath)s\\mvtools2.dll")\n'
-            '%(source)s'
-            'BilinearResize(8 * int((240 * last.width/last.height) / 8), 240)\n'
+            '%(source)s\n'
+            )
+        if trim:
+            script += '%(trim)s\n'
+        script += (
+            'BilinearResize(8 * int((%(height)i * last.width/last.height) / 8), '
+            '%(height)i)\n'
             'ConvertToYV12()\n'
             'SCXvid("%(keylog)s")\n'
             )
-        if not self.nomo:
+        if mvlog:
             script += (
                 'vectors = MSuper().MAnalyse()\n'
                 'MDepan(vectors, log="%(mvlog)s")'
             )
-        script = script % {"rpath": self.rpath,
-                           "ppath": self.picpath,
-                           "vidfn": self.vidfn,
-                           "source": self.source,
-                           "keylog": keylog,
-                           "mvlog": mvlog}
-
-        with AvisynthHelper(script) as clip:
-            # Store information about the clip for later
-            self.get_vid_info(clip)
-            framecount = self.vid_info["framecount"]
+        return script % {"rpath": self.rpath,
+                         "source": self.source,
+                         "trim": trim,
+                         "height": height,
+                         "keylog": keylog,
+                         "mvlog": mvlog}
+
+    @timed("detection_pass")
+    def detection_pass(self, script, title):
+        """Run every frame of a detection script through Avisynth.
+        Returns the (width, height) the script analysed.
+        The environment isn't pooled: SCXvid and MDepan only finish their
+        logs when they are destroyed, and the script's variables would keep
+        them alive in an idle pooled environment."""
+        # The detection pass runs on its own so it gets the whole budget
+        memory_max = memory.cache_budget(1, self.memory_max)
+        with AvisynthHelper(script, memory_max=memory_max, raw=True) as clip:
+            vi = clip.GetVideoInfo()
+            size = (int(vi.width), int(vi.height))
+            framecount = int(vi.num_frames)
 
             widgets = [
-                        '(1/2) Scene Detection: ', pb.Percentage(),
+                        title, pb.Percentage(),
                         ' ', pb.Bar(marker=pb.RotatingMarker()),
                         ' ', pb.ETA()
                       ]
             pbar = pb.ProgressBar(widgets=widgets, maxval=framecount).start()
+            tracker = stream.progress("detection_pass", framecount, "frames")
 
-            for frame in range(framecount):
-                clip._GetFrame(frame)
+            def progress(frame):
                 pbar.update(frame)
+                tracker.update(frame)
+            with stream.stage("detection_pass", title=title.strip(" :"),
+                              frames=framecount, width=size[0],
+                              height=size[1]):
+                pump_frames(clip, framecount, progress=progress)
+            tracker.update(framecount)
             pbar.finish()
+        return size
+
+    @is_ready
+    @timed("scene_detection")
+    def scene_detection(self):
+        """Use SCXvid to generate a list of scene keyframes.
+        Simlutaneously, using MDepan to log the motion vectors.
+
+        In coarse mode the whole video is first checked at a tiny size
+        (which also logs the motion) and SCXvid then runs at full size
+        only on short windows around the candidate cuts."""
+
+        keylog = os.path.join(self.picpath, "keyframes.log")
+        mvlog = os.path.join(self.picpath, "vectors.log")
+        if self.nomo:
+            mvlog = None
+
+        if self.coarse_height:
+            coarse_log = os.path.join(self.picpath, "keyframes_coarse.log")
+            script = self.detection_script(self.coarse_height, coarse_log,
+                                           mvlog=mvlog)
+            # Motion vectors are measured at the detection size
+            self.detect_size = self.detection_pass(script,
+                                                   '(1/2) Coarse Detection: ')
+            with open(coarse_log, "r") as log:
+                coarse_flags = read_keyframe_flags(log)
+            framecount = self.vid_info["framecount"]
+            pad = max(coarse_pad, self.min_slength)
+            windows = candidate_windows(coarse_flags, framecount, pad)
+            flags = []
+            if windows:
+                script = self.detection_script(self.detect_height, keylog,
+                                               trim=trim_script(windows))
+                self.detection_pass(script, '(1/2) Fine Detection:   ')
+                with open(keylog, "r") as log:
+                    window_flags = read_keyframe_flags(log)
+                flags = map_window_flags(windows, window_flags, framecount)
+            self.set_scenes(flags)
+        else:
+            script = self.detection_script(self.detect_height, keylog,
+                                           mvlog=mvlog)
+            # Motion vectors are measured at the detection size
+            self.detect_size = self.detection_pass(script,
+                                                   '(1/2) Scene Detection: ')
+            self.read_scenes(keylog)
 
-        self.scenes = self.read_scenes(keylog)
-        vdata = []
         if not self.nomo:
             with open(mvlog, "r") as mv:
-                vdata = mv.readlines()
-                self.all_vectors, self.vectors = self.read_vectors(self.scenes,
-                                                                   vdata)
+                self.motion = read_motion(mv)
+            self.read_vectors(self.table, self.motion)
 
         return
 
-    def read_vectors(self, scenes, vdata):
-        """Analyse MDepan's output per scene.
+    @timed("read_vectors")
+    def read_vectors(self, table, motion):
+        """Analyse MDepan's output per scene, setting the motion tags and
+        activity of each scene in the table.
 
         Depan logs follow the deshaker format with each line printing:
 
@@ -342,86 +837,50 @@ class Analyser(object):
                 (the middle line of) the previous frame and current frame.
         Zoom - The zoom factor between (the middle line of) the previous
                frame and current frame.
+
+        A scene's activity is its total movement in frame widths, used to
+        give busy scenes more samples. motion is the log as read by
+        read_motion, one row per frame.
         """
-        all_movements = set()
-        scene_vect = defaultdict(list)
-        for start, end in scenes:
-            vx = 0.
-            vy = 0.
-            vr = 0.
-            vz = 100.
-            for i in range(start, end + 1):
-                if i >= len(vdata):
-                    break
-                bits = vdata[i].split()
-                if bits and len(bits) >= 5:
-                    vx += float(bits[1])
-                    vy += float(bits[2])
-                    vr += float(bits[3])
-                    vz *= float(bits[4])
-            if abs(vx) > (self.vid_info["width"] / 10.):
-                scene_vect[start].append("m3_left" if vx < 0 else "m4_right")
-            if abs(vy) > (self.vid_info["height"] / 10.):
-                scene_vect[start].append("m2_down" if vy > 0 else "m1_up")
-            if abs(vr) > 10:
-                scene_vect[start].append("m6_ccw" if vr > 0 else "m5_cw")
-            if not (vz > 90 and vz < 110):
-                scene_vect[start].append("m8_out" if vz > 100 else "m7_in")
-            if scene_vect[start]:
-                all_movements = all_movements | set(scene_vect[start])
-        return all_movements, scene_vect
+        tag_motion(table, motion, self.detect_size)
 
+    @timed("read_scenes")
     def read_scenes(self, fn):
         """Get all the keyframes from the log file. Store them and the time
         they occurred in the video."""
-        keyframes = [0]
-        endframes = []
         with open(fn, "r") as log:
-            # The log file starts with 3 unneeded lines
-            for i, line in enumerate(log.readlines()[3:]):
-                # Minimum scene length in frames
-                slength = (i - keyframes[-1])
-                if line.startswith("i") and slength >= self.min_slength:
-                    keyframes.append(i)
-                    endframes.append(i - 1)
-        if not endframes:
-            raise Exception("Error: video file only had once scene :(")
-        # Make sure we add the last scene
-        if endframes[-1] != self.vid_info["framecount"]:
-            keyframes.append(endframes[-1] + 1)
-            endframes.append(self.vid_info["framecount"])
-        self.scenes = zip(keyframes, endframes)
-
-        for scene in self.scenes:
-            for frame in scene:
-                fps_den = self.vid_info["fps_den"]
-                fps_num = self.vid_info["fps_num"]
-                self.times[frame] = float(frame) * fps_den / fps_num
-        return self.scenes
-
-    def get_timestamp(self, frame):
-        """Return timestamp for a particular frame."""
-        time = self.times[frame]
-        return "%02i:%02i:%02i.%02i" % (time // 3600,
-                                        time // 60 % 60,
-                                        time % 60,
-                                        100 * (time % 1))
+            return self.set_scenes(read_keyframe_flags(log))
+
+    def set_scenes(self, flags):
+        """Store the scenes for a list of per-frame keyframe flags in a new
+        scene table."""
+        scenes = scenes_from_flags(flags, self.vid_info["framecount"],
+                                   self.min_slength)
+        self.table = SceneTable(scenes, self.vid_info["fps_num"],
+                                self.vid_info["fps_den"])
+        return self.table
 
     @is_ready
+    @timed("phase_two")
     def phase_two(self):
         """This phase simlutaneously does many things:
         1. Finds the most common colours in the scene
         2. Looks for faces
         3. Writes the jpeg filmstrips
+
+        Avisynth only resizes to the largest size needed; the workers make
+        the smaller colour, face and thumbnail frames from that.
         """
+        self.resize_stage = self.get_resize_stage()
+        width, height = self.resize_stage.largest()
         script = (
-            '%(source)s'
-            'BilinearResize(8 * int((240 * last.width/last.height) / 8), 240)'
-        ) % {"source": self.source}
+            '%(source)s\n'
+            'BilinearResize(%(width)i, %(height)i)'
+        ) % {"source": self.source,
+             "width": width,
+             "height": height}
 
-        self.img_data = []
-        self.colours = defaultdict(set)
-        self.all_colours = set()
+        table = self.table
 
         widgets = ['(2/2) Scene Analysis:  ',
                    pb.Percentage(),
@@ -430,110 +889,199 @@ class Analyser(object):
                    ' ',
                    pb.ETA()]
         pbar = pb.ProgressBar(widgets=widgets,
-                              maxval=len(self.scenes)).start()
+                              maxval=len(table)).start()
+
+        memory_max = memory.cache_budget(self.cpus, self.memory_max)
 
         # Create queues
         task_queue = Queue()
         done_queue = Queue()
 
+        table.frames[:] = self.plan_samples()
+        print "Sampling %i frames from %i scenes" % (table.frames.sum(),
+                                                      len(table))
+
         # Submit tasks
-        for start, end in self.scenes:
-            task_queue.put((self, start, end))
+        assert self.task_size_fixed(), "Tasks would carry the keyframes"
+        for (start, end), count in zip(table, table.frames.tolist()):
+            frames = self.sample_frames(start, end, count)
+            task_queue.put((self, start, end, frames))
 
         # Start worker processes
+        profile_every = self.profile_every if self.profile_report else 0
+        workers = []
         for i in range(self.cpus):
-            args = (script, task_queue, done_queue)
-            Process(target=mp_image_process, args=args).start()
+            args = (script, task_queue, done_queue, self.encoder_options,
+                    self.envs, memory_max, timings.enabled, profile_every,
+                    self.picpath, stream.f is not None)
+            workers.append(Process(target=mp_image_process, args=args))
+            workers[-1].start()
 
         # Get and print results
-        for i, scene in enumerate(self.scenes):
-            start, has_face, colours = done_queue.get()
-            if has_face:
-                self.vectors[start].append("has_face")
-                self.all_vectors.add("has_face")
-            for colour in colours:
-                self.colours[start].add(colour)
-                self.all_colours.add(colour)
-            pbar.update(i)
+        reused = 0
+        finished = 0
+        frames_done = 0
+        tracker = stream.progress("phase_two", len(table), "scenes")
+        while finished < len(table):
+            result = worker_message(done_queue, workers)
+            if result[0] == "PROGRESS":
+                stream.emit("worker_progress", **result[1])
+                continue
+            start, tags, scene_hash, scene_palette, matched = result
+            row = table.index(start)
+            table.add_tags(row, tags)
+            table.phash[row] = scene_hash
+            if scene_palette is not None:
+                table.palette[row] = scene_palette
+            reused += matched
+            pbar.update(finished)
+            finished += 1
+            frames_done += int(table.frames[row])
+            tracker.update(finished, frames=frames_done)
 
         # Stop the queues
         for i in range(self.cpus):
             task_queue.put('STOP')
 
-        pbar.finish()
-        self.all_vectors = [x.split("_")[-1] for x in sorted(self.all_vectors)]
-        self.img_data = self.get_img_data()
-
-    def process_images(self, clip, start, end):
-        has_face = False
-        colours = set()
-        images = []
-        sample = takespread(range(start, end + 1), self.samplesize)
-        for i, frame in enumerate(sample):
-            npa = get_numpy(clip, frame)
-            images.append(npa)
-
-            # Should we skip facial recognition?
-            if self.noface or i % self.faceprec:
+        # Wait for each worker to finish writing its filmstrips
+        self.bytes_written = 0
+        peaks = []
+        while len(peaks) < self.cpus:
+            message, stats = worker_message(done_queue, workers)
+            if message == "PROGRESS":
+                stream.emit("worker_progress", **stats)
                 continue
+            self.bytes_written += stats["bytes"]
+            peaks.append(stats["peak_memory"])
+            if "timings" in stats:
+                timings.merge(stats["timings"])
+            if "profile" in stats:
+                self.worker_profiles.append(stats["profile"])
 
-            # Facial recognition
-            if not has_face:
-                # Copy the image for facial analysis
-                new = numpy.empty_like(npa)
-                new[:] = npa
-                if face.detect(new):
-                    has_face = True
-        # Generate and save the filmstrip
-        stacked = numpy.concatenate(images, axis=0)
-        img_path = self.get_scene_img_path(start, end)
-        img = Image.fromarray(stacked)
-        img.save(img_path)
+        pbar.finish()
+        self.save_results()
+        print "Filmstrips: %s written for %i scenes" % (
+            human_size(self.bytes_written), len(table))
+        print "Workers: %i MB Avisynth cache each, peak usage %s MB" % (
+            memory_max, ", ".join(str(p) for p in sorted(peaks)))
+        self.worker_peaks = peaks
+        if self.match_bits:
+            print "Copied the tags of %i scenes from catalogued repeats" % (
+                reused)
+        self.analysed = True
+
+    def save_results(self):
+        """Save the scene table, per-frame motion and what the exporters
+        need to know about the video, so they can be run again later."""
+        video = dict(self.vid_info)
+        video.pop("keyframes", None)
+        meta = {
+            "video": video,
+            "thumb_size": list(self.thumb_size),
+            "img_ext": self.encoder_options["fmt"],
+            "nocol": self.nocol,
+            "noface": self.noface,
+            "bytes": self.bytes_written,
+        }
+        columns = self.table.columns()
+        if self.motion is not None:
+            columns["motion"] = self.motion.astype(numpy.float32)
+        results.save(self.resultspath, meta, columns)
+
+    def load_results(self):
+        """Restore the analysis from the saved results, without opening
+        the video."""
+        if not os.path.exists(self.resultspath):
+            raise Exception("No saved results for %s, run it without "
+                            "--rebuild first." % self.vidfn)
+        meta, columns = results.load(self.resultspath)
+        self.vid_info = meta["video"]
+        self.thumb_size = tuple(meta["thumb_size"])
+        self.encoder_options["fmt"] = meta["img_ext"]
+        self.nocol = meta["nocol"]
+        # Results saved before noface was kept may not have looked for faces
+        self.noface = meta.get("noface", True)
+        self.bytes_written = meta["bytes"]
+        self.table = SceneTable.from_columns(columns,
+                                             self.vid_info["fps_num"],
+                                             self.vid_info["fps_den"])
+        self.motion = columns.get("motion")
+        self.analysed = True
+
+    def plan_samples(self):
+        """Return the number of frames to sample from each scene, either
+        --frames for every scene or a share of --budget."""
+        lengths = self.table.lengths()
+        if not self.budget:
+            return numpy.minimum(self.samplesize, lengths)
+        return plan_samples(lengths, self.table.activity, self.budget,
+                            self.min_frames, self.max_frames)
+
+    def sample_frames(self, start, end, count):
+        """Frames for a scene's filmstrip: an even spread, moved onto
+        nearby keyframes with --snap."""
+        sample = list(takespread(range(start, end + 1), count))
+        if not self.keyframes:
+            return sample
+        snapped = []
+        for frame in sample:
+            near = snap_frame(frame, self.keyframes, start, end, self.snap)
+            # Keep the original frame rather than show a frame twice, either
+            # a keyframe already used or another sample's own frame
+            if near in snapped or (near != frame and near in sample):
+                near = frame
+            snapped.append(near)
+        return sorted(snapped)
+
+    def process_images(self, clip, encoder, start, end, frames):
+        """Write a scene's filmstrip and tag it. Returns (start, tag
+        bitmask, perceptual hash, colour palette or None with --no-colours,
+        whether the tags came from a matching scene in the catalog)."""
+        catalog = None
+        if self.match_bits:
+            catalog = get_worker_catalog(self.catalog_path)
+        return (start,) + process_scene(
+            clip, encoder, self.resize_stage, frames,
+            self.get_scene_img_path(start, end), num_colours=self.num_colours,
+            nocol=self.nocol, noface=self.noface, faceprec=self.faceprec,
+            face_profile=self.face_profile, catalog=catalog,
+            match_bits=self.match_bits, reuse_mask=self.get_reuse_mask(),
+            video_path=os.path.abspath(self.vidpath))
+
+    def get_reuse_mask(self):
+        """The tags phase two finds, which can be copied from a matching
+        scene."""
+        names = []
         if not self.nocol:
-            # Quantize the image, find the most common colours
-            for c in most_frequent_colours(img, top=self.num_colours):
-                colour = get_colour_name(c[:3])
-                colours.add(colour)
-        return (start, has_face, colours)
+            names += colour_tags
+        if not self.noface:
+            names += face_tags
+        return tag_mask(names)
+
+    def get_scene_img_name(self, start, end):
+        return scene_img_name(start, end, self.encoder_options["fmt"])
 
     def get_scene_img_path(self, start, end):
-        return os.path.join(self.picpath, "scene_%i_%i.jpg" % (start, end))
-
-    def get_img_data(self):
-        """For each scene track a number of items for use by
-        html and xml exporters"""
-        data = []
-        for i, scene in enumerate(self.scenes):
-            start, end = scene
-            folder = os.path.split(self.picpath)[-1]
-            fn = "%s/scene_%i_%i.jpg" % (folder, start, end)
-            ts = "%s - %s" % (self.get_timestamp(start),
-                              self.get_timestamp(end))
-            colours = [kelly_colours[c][0] for c in self.colours[start]]
-            title = "Scene %i, frames %i to %i,  %s" % (i, start, end, ts)
-            if not self.nocol:
-                title += " with colours %s" % (", ".join(colours))
-            data.append({
-                "i": i,
-                "filename": fn,
-                "vidpath": self.vidpath,
-                "colours": colours,
-                "vectors": [x.split("_")[-1] for x in self.vectors[start]],
-                "start": start,
-                "end": end,
-                "ts": ts,
-                "size": (self.vid_info["width"], self.vid_info["height"]),
-                "title": title,
-            })
-        return data
+        return os.path.join(self.picpath, self.get_scene_img_name(start, end))
+
+    def scene_rows(self):
+        """Yield a dictionary per scene for the html and xml exporters,
+        made from the scene table as they are needed."""
+        return scene_rows(self.table, os.path.split(self.picpath)[-1],
+                          self.vidpath, self.thumb_size,
+                          self.encoder_options["fmt"], colours=not self.nocol)
 
     @is_ready
-    def output_html(self):
-        """Render an html file using jinja2 based on the scene information."""
-        if not self.img_data:
+    @timed("html")
+    def output_html(self, virtual=False):
+        """Render an html file using jinja2 based on the scene information.
+        A virtual index only creates elements for the scenes in view."""
+        if not self.analysed:
             return
-        template_file = os.path.join(self.rpath, "template.html")
-        template = Template(open(template_file, "r").read())
+        template_name = "template.html"
+        if virtual:
+            template_name = "template_virtual.html"
+        template = get_template(self.rpath, template_name)
 
         # Copy icons and javascript to picdir
         if not os.path.exists(os.path.join(self.picpath, "icons")):
@@ -544,63 +1092,97 @@ class Analyser(object):
                 shutil.copy2(os.path.join(self.rpath, js),
                              os.path.join(self.picpath, js))
 
+        options = html_options(self.table, os.path.split(self.picpath)[-1],
+                               self.vidpath, self.vidfn, self.thumb_size,
+                               self.encoder_options["fmt"],
+                               colours=not self.nocol, virtual=virtual)
         vidhtml = os.path.join(self.vidroot, "%s.html" % self.vidname)
         with open(vidhtml, "w") as f:
-            k_colours = []
-            sort_colours = sorted(kelly_colours.items(), key=lambda t: t[1][2])
-            for colour, items in sort_colours:
-                name = items[0]
-                k_colours.append((name, colour, colour in self.all_colours))
-            if self.nocol:
-                k_colours = []
-
-            options = {
-                "img_data": self.img_data,
-                "k_colours": k_colours,
-                "all_vectors": ["up", "down", "left", "right",
-                                "cw", "ccw", "in", "out", "face"],
-                "used_vectors": self.all_vectors,
-                "dir": os.path.split(self.picpath)[-1],
-                "vidfn": self.vidfn,
-                "icon_key": {
-                            "up": "Pan up",
-                            "down": "Pan down",
-                            "left": "Pan left",
-                            "right": "Pan right",
-                            "cw": "Clockwise rotation",
-                            "ccw": "Counter-clockwise rotation",
-                            "in": "Zoom in",
-                            "out": "Zoom out",
-                            "has_face": "Contains faces",
-                            "no_face": "Does not contain faces",
-                            "reset": "Reset all options",
-                        },
-            }
-            f.write(template.render(options))
+            write_html(f, template, options)
 
     @is_ready
+    @timed("xml")
     def output_xml(self):
         """Produce a Final Cut Pro .xml file for importing into programs.
         Only tested with Premiere CS6 currently."""
-        if not self.img_data:
+        if not self.analysed:
             return
-        xml = make_xml(self.vidpath, self.img_data)
-        xmlfile = self.xmlpath
-        with open(xmlfile, "w") as f:
-            f.write('<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE xmeml>')
-            xml.write(f)
+        with open(self.xmlpath, "w") as f:
+            write_xml(f, self.vidpath, self.scene_rows(), self.vid_info)
+
+    @is_ready
+    @timed("catalog")
+    def update_catalog(self):
+        """Add or replace this video's scenes in the library catalog."""
+        table = self.table
+        video = {
+            "path": os.path.abspath(self.vidpath),
+            "size": self.vid_info["size"],
+            "mtime": self.vid_info["mtime"],
+            "framecount": self.vid_info["framecount"],
+            "fps_num": table.fps_num,
+            "fps_den": table.fps_den,
+            "html": os.path.abspath(self.htmlpath),
+            "tagged": self.get_reuse_mask(),
+        }
+        strips = [os.path.abspath(self.get_scene_img_path(start, end))
+                  for start, end in table]
+        # Scenes analysed with --no-colours, or saved before palettes were
+        # added, have none
+        palettes = [p if p.any() else None for p in table.palette]
+        scenes = zip(range(len(table)), table.start.tolist(),
+                     table.end.tolist(), table.start_times().tolist(),
+                     table.end_times().tolist(), table.timestamps().tolist(),
+                     table.tags.tolist(), strips, table.phash.tolist(),
+                     palettes)
+        with Catalog(self.catalog_path) as catalog:
+            catalog.upsert(video, scenes)
 
     @is_ready
-    def run(self, html=True, xml=True, popups=True):
-        if not (self.scenes and self.vectors):
-            self.scene_detection()
-        if not self.img_data:
-            self.phase_two()
-        if self.img_data:
+    def write_profile_report(self, elapsed):
+        """Write the timings of this video's stages, merged across the
+        workers, and any cProfile stats to the --profile-report file."""
+        report = {
+            "video": self.vidpath,
+            "seconds": elapsed,
+            "framecount": self.vid_info.get("framecount"),
+            "scenes": len(self.table) if self.table is not None else 0,
+            "frames_sampled": (int(self.table.frames.sum())
+                               if self.table is not None else 0),
+            "cpus": self.cpus,
+            "worker_peak_memory": self.worker_peaks,
+            "stages": timings.summary(),
+        }
+        if self.worker_profiles:
+            output = os.path.splitext(self.profile_report)[0] + ".prof"
+            report["profile"] = merge_profiles(self.worker_profiles, output)
+            report["profile_stats"] = output
+        profiling.write_report(self.profile_report, report)
+        print "Profile report written to %s" % self.profile_report
+
+    @is_ready
+    def run(self, html=True, xml=True, popups=True, virtual=False):
+        started = time.time()
+        if self.table is None:
+            with stream.stage("scene_detection"):
+                self.scene_detection()
+            stream.emit("scenes", count=len(self.table))
+        if not self.analysed:
+            with stream.stage("phase_two", scenes=len(self.table),
+                              workers=self.cpus):
+                self.phase_two()
+        if self.analysed:
             if html:
-                self.output_html()
+                with stream.stage("html"):
+                    self.output_html(virtual=virtual)
             if xml:
-                self.output_xml()
+                with stream.stage("xml"):
+                    self.output_xml()
+            if self.catalog_path:
+                with stream.stage("catalog"):
+                    self.update_catalog()
+        if self.profile_report:
+            self.write_profile_report(time.time() - started)
         if os.path.exists(self.htmlpath) and popups:
             webbrowser.open(self.htmlpath, new=2)
 
@@ -658,17 +1240,111 @@ def ask_for_file():
     return tkFileDialog.askopenfilename(**foptions)
 
 
-def get_cl_args():
+def get_catalog_path(arguments):
+    """The catalog given on the command line or the default one."""
+    path = arguments.get("--catalog")
+    if path:
+        return path.strip()
+    return os.path.join(metadata.cache_dir(), "catalog.sqlite")
+
+
+def query_catalog(arguments):
+    """Print every catalogued scene with all the given tags."""
+    limit = arguments.get("--limit").strip()
+    if limit.isdigit() == False:
+        raise Exception("--limit must be an integer >= 0")
+    path = get_catalog_path(arguments)
+    if not os.path.exists(path):
+        raise Exception("No scene catalog at %s" % path)
+    names = [name.lower() for name in arguments.get("<TAG>")]
+    with Catalog(path) as catalog:
+        started = time.time()
+        found = catalog.query(names, limit=int(limit))
+        elapsed = time.time() - started
+        for vidpath, scene, start, end, ts, strip in found:
+            print "%s  scene %i (%s)  %s" % (vidpath, scene, ts, strip)
+        print "%i scenes found in %i videos in %.1f ms" % (
+            len(found), catalog.videos(), elapsed * 1000)
+
+
+def list_duplicates(arguments):
+    """Print groups of catalogued scenes that look like the same footage,
+    optionally only those involving some videos."""
+    max_bits = arguments.get("--distance").strip()
+    if max_bits.isdigit() == False or int(max_bits) > phash_max_distance:
+        raise Exception("--distance must be an integer from 0 to %i" %
+                        phash_max_distance)
+    path = get_catalog_path(arguments)
+    if not os.path.exists(path):
+        raise Exception("No scene catalog at %s" % path)
+    videos = [os.path.abspath(p) for p in arguments.get("<PATH>")]
+    with Catalog(path) as catalog:
+        started = time.time()
+        groups = catalog.duplicates(int(max_bits), paths=videos)
+        elapsed = time.time() - started
+        for group in groups:
+            for vidpath, scene, ts in group:
+                print "%s  scene %i (%s)" % (vidpath, scene, ts)
+            print ""
+        print "%i groups of repeated scenes found in %.1f s" % (len(groups),
+                                                               elapsed)
+
+
+def parse_palette(colours):
+    """Make a palette from comma separated hex colours and Kelly colour
+    names, each an equal share."""
+    names = dict((value[0], key) for key, value in kelly_colours.items())
+    rgb = []
+    for colour in colours.split(","):
+        colour = colour.strip().lower()
+        colour = names.get(colour, colour).lower()
+        if not re.match("^#[0-9a-f]{6}$", colour):
+            raise Exception("%s is not a #RRGGBB colour or Kelly colour name"
+                            % colour)
+        rgb.append([int(colour[i:i + 2], 16) for i in (1, 3, 5)])
+    return histogram(numpy.array([rgb], dtype=numpy.uint8))
+
+
+def find_similar(arguments):
+    """Print the catalogued scenes whose colour palettes are nearest to a
+    scene's or to a list of colours."""
+    limit = arguments.get("--limit").strip()
+    if limit.isdigit() == False:
+        raise Exception("--limit must be an integer >= 0")
+    path = get_catalog_path(arguments)
+    if not os.path.exists(path):
+        raise Exception("No scene catalog at %s" % path)
+    with Catalog(path) as catalog:
+        if arguments.get("--palette"):
+            query = parse_palette(arguments.get("--palette"))
+        else:
+            scene = arguments.get("<SCENE>").strip()
+            if scene.isdigit() == False:
+                raise Exception("<SCENE> must be a scene number")
+            query = catalog.scene_palette(
+                os.path.abspath(arguments.get("<VIDEO>")), int(scene))
+        started = time.time()
+        found = catalog.similar_palettes(query, limit=int(limit))
+        elapsed = time.time() - started
+        for distance, vidpath, scene, ts, strip in found:
+            print "%s  scene %i (%s)  %.1f  %s" % (vidpath, scene, ts,
+                                                   distance, strip)
+        print "%i scenes found in %.1f ms" % (len(found), elapsed * 1000)
+
+
+def get_cl_args(arguments):
     """"
     Process the command line arguments and parse them for use.
     """
-    arguments = docopt(__doc__, version='%s' % version_string)
 
     silent = arguments.get("--silent")
     if silent:
         # Consume all messages
         class Consume(object):
-            def write(self):
+            def write(self, text):
+                pass
+
+            def flush(self):
                 pass
         sys.stdout = Consume()
 
@@ -702,6 +1378,94 @@ def get_cl_args():
             raise Exception("--cpus must be an integer >= 1")
         cpus = int(cpus)
 
+    height = arguments.get("--height").strip()
+    if height.isdigit() == False or int(height) < 16:
+        raise Exception("--height must be an integer >= 16")
+    height = int(height)
+
+    stage_heights = {}
+    for option in ("--detect-height", "--colour-height", "--face-height"):
+        value = arguments.get(option).strip()
+        if value.isdigit() == False or int(value) < 16:
+            raise Exception("%s must be an integer >= 16" % option)
+        stage_heights[option] = int(value)
+
+    thumb_format = arguments.get("--format").strip().lower().lstrip(".")
+    if thumb_format == "jpeg":
+        thumb_format = "jpg"
+    if thumb_format not in ("jpg", "webp"):
+        raise Exception("--format must be jpg or webp")
+
+    quality = arguments.get("--quality").strip()
+    if quality.isdigit() == False or not (1 <= int(quality) <= 95):
+        raise Exception("--quality must be an integer from 1 to 95")
+    quality = int(quality)
+
+    chroma = arguments.get("--chroma").strip()
+    if chroma not in ("0", "1", "2"):
+        raise Exception("--chroma must be 0, 1 or 2")
+    chroma = int(chroma)
+
+    writers = arguments.get("--writers").strip()
+    if writers.isdigit() == False or int(writers) < 1:
+        raise Exception("--writers must be an integer >= 1")
+    writers = int(writers)
+
+    envs = arguments.get("--envs").strip()
+    if envs.isdigit() == False:
+        raise Exception("--envs must be an integer >= 0")
+    envs = int(envs)
+
+    memory_max = arguments.get("--memory")
+    if memory_max:
+        memory_max = memory_max.strip()
+        if memory_max.isdigit() == False or int(memory_max) < 8:
+            raise Exception("--memory must be an integer >= 8")
+        memory_max = int(memory_max)
+
+    coarse = arguments.get("--coarse").strip()
+    if coarse.isdigit() == False or (int(coarse) and int(coarse) < 16):
+        raise Exception("--coarse must be 0 or an integer >= 16")
+    coarse = int(coarse)
+
+    snap = arguments.get("--snap").strip()
+    if snap.isdigit() == False:
+        raise Exception("--snap must be an integer >= 0")
+    snap = int(snap)
+
+    face_profile = face.load_profile(arguments.get("--face-profile").strip())
+
+    match_bits = arguments.get("--match").strip()
+    if match_bits.isdigit() == False or int(match_bits) > phash_max_distance:
+        raise Exception("--match must be an integer from 0 to %i" %
+                        phash_max_distance)
+    match_bits = int(match_bits)
+    if match_bits and arguments.get("--no-catalog"):
+        raise Exception("--match needs the catalog")
+
+    profile_every = arguments.get("--profile-every").strip()
+    if profile_every.isdigit() == False:
+        raise Exception("--profile-every must be an integer >= 0")
+    profile_every = int(profile_every)
+    profile_report = arguments.get("--profile-report")
+    if profile_report:
+        profile_report = os.path.abspath(profile_report.strip())
+
+    budget = arguments.get("--budget").strip()
+    if budget.isdigit() == False:
+        raise Exception("--budget must be an integer >= 0")
+    budget = int(budget)
+
+    min_frames = arguments.get("--min-frames").strip()
+    if min_frames.isdigit() == False or int(min_frames) < 1:
+        raise Exception("--min-frames must be an integer >= 1")
+    min_frames = int(min_frames)
+
+    max_frames = arguments.get("--max-frames").strip()
+    if max_frames.isdigit() == False or int(max_frames) < min_frames:
+        raise Exception("--max-frames must be an integer >= --min-frames")
+    max_frames = int(max_frames)
+
     # Set up options for running the analyser
     analyser_kwargs = {
         "skip": arguments.get("--skip"),
@@ -709,21 +1473,64 @@ def get_cl_args():
         "nocol": arguments.get("--no-colours"),
         "nomo": arguments.get("--no-motion"),
         "noface": arguments.get("--no-face"),
+        "nocrop": arguments.get("--no-crop"),
+        "rebuild": arguments.get("--rebuild"),
+        "match_bits": match_bits,
+        "catalog_path": (None if arguments.get("--no-catalog")
+                         else get_catalog_path(arguments)),
         "frames": frames,
         "min_slength": min_slength,
         "faceprec": faceprec,
         "num_colours": colours,
         "cpus": cpus,
+        "thumb_height": height,
+        "detect_height": stage_heights["--detect-height"],
+        "colour_height": stage_heights["--colour-height"],
+        "face_height": stage_heights["--face-height"],
+        "face_profile": face_profile,
+        "thumb_format": thumb_format,
+        "quality": quality,
+        "subsampling": chroma,
+        "writers": writers,
+        "progressive": not arguments.get("--baseline"),
+        "envs": envs,
+        "memory_max": memory_max or 0,
+        "coarse_height": coarse,
+        "snap": snap,
+        "budget": budget,
+        "min_frames": min_frames,
+        "max_frames": max_frames,
+        "profile_report": profile_report,
+        "profile_every": profile_every,
     }
     run_kwargs = {
         "xml": not arguments.get("--no-xml"),
         "popups": not arguments.get("--no-popups"),
+        "virtual": arguments.get("--virtual"),
     }
     return vpath, analyser_kwargs, run_kwargs
 
 
+def get_video_report(path, vidpath):
+    """Name a batch's profile report after its video."""
+    root, ext = os.path.splitext(path)
+    name = os.path.splitext(os.path.basename(vidpath))[0]
+    return "%s_%s%s" % (root, name, ext)
+
+
 def main():
     """Handle default processing for standalone and command-line usage."""
+    arguments = docopt(__doc__, version='%s' % version_string)
+    if arguments.get("query"):
+        query_catalog(arguments)
+        return
+    if arguments.get("dupes"):
+        list_duplicates(arguments)
+        return
+    if arguments.get("similar"):
+        find_similar(arguments)
+        return
+
     # Surpress TKinter main window
     root = Tkinter.Tk()
     root.withdraw()
@@ -732,23 +1539,42 @@ def main():
     icon = os.path.realpath(os.path.join(basedir, "resources", "scenic.ico"))
     root.wm_iconbitmap(icon)
 
-    vpath, analyser_kwargs, run_kwargs = get_cl_args()
+    vpath, analyser_kwargs, run_kwargs = get_cl_args(arguments)
 
     vids = get_valid_files(vpath)
 
-    for i, vid in enumerate(vids, 1):
-        if len(vids) > 1:
-            print "::: Batch mode: file %s of %s:::" % (i, len(vids))
-        if len(vids) > 1 and __debug__:
+    if arguments.get("--events"):
+        stream.open(arguments.get("--events"))
+    stream.emit("batch_start", videos=len(vids))
+    started = time.time()
+    try:
+        for i, vid in enumerate(vids, 1):
+            if len(vids) > 1:
+                print "::: Batch mode: file %s of %s:::" % (i, len(vids))
+            kwargs = dict(analyser_kwargs)
+            if len(vids) > 1 and kwargs["profile_report"]:
+                kwargs["profile_report"] = get_video_report(
+                    kwargs["profile_report"], vid)
+            stream.emit("video_start", video=vid, index=i, videos=len(vids))
+            video_started = time.time()
             try:
-                Analyser(vid, **analyser_kwargs).run(**run_kwargs)
+                Analyser(vid, **kwargs).run(**run_kwargs)
             except Exception as e:
-                print "Error while analysing %s: %s" % (vid, e)
-                continue
-        else:
-            Analyser(vid, **analyser_kwargs).run(**run_kwargs)
-        if len(vids) > 1:
-            print ""
+                stream.emit("video_error", video=vid, error=str(e))
+                if len(vids) > 1 and __debug__:
+                    print "Error while analysing %s: %s" % (vid, e)
+                    continue
+                raise
+            stream.emit("video_end", video=vid,
+                        seconds=time.time() - video_started)
+            if len(vids) > 1:
+                print ""
+        stream.emit("batch_end", videos=len(vids),
+                    seconds=time.time() - started)
+    finally:
+        # Flush and close the --events target even if a video failed
+        stream.close()
+    env_pool.close()
 
 if __name__ == "__main__":
     if getattr(sys, 'frozen', False) or not __debug__:
@@ -0,0 +1,25 @@
+from color import kelly_colours
+
+# Each scene's tags are stored as one integer with a bit per tag so the html
+# index can filter with bitwise operations. Kelly colours come first in their
+# display order, followed by the motion directions and faces. There are 31
+# tags so every mask fits in a javascript Uint32Array.
+colour_tags = [items[0] for key, items in
+               sorted(kelly_colours.items(), key=lambda t: t[1][2])]
+motion_tags = ["up", "down", "left", "right", "cw", "ccw", "in", "out"]
+face_tags = ["face"]
+tag_names = colour_tags + motion_tags + face_tags
+tag_bits = dict((name, 1 << i) for i, name in enumerate(tag_names))
+
+
+def tag_mask(names):
+    """Return the bitmask for an iterable of tag names."""
+    mask = 0
+    for name in names:
+        mask |= tag_bits[name]
+    return mask
+
+
+def mask_tags(mask, names=tag_names):
+    """Return the tag names set in a bitmask, in bit order."""
+    return [name for name in names if mask & tag_bits[name]]
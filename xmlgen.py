@@ -3,18 +3,8 @@ import xml.etree.cElementTree as ET
 import re
 import uuid
 
-from mediainfo.MediaInfoDLL import *
-MI = MediaInfo()
-Version = MI.Option_Static("Info_Version",
-                            "0.7.7.0;MediaInfoDLL_Example_Python;0.7.7.0")
-if Version == "":
-    print "\nMediaInfo.Dll: this version of the DLL is not compatible"
-
 pattern = re.compile('[\W_]+')
 
-clip_counter = 0
-subclip_counter = 0
-
 
 def path2url(path):
     folder, fn = os.path.split(path)
@@ -27,149 +17,168 @@ def batch_node(items, parent):
         thing.text = text
 
 
-def make_clip_xml(fn, parent, finfo, inframe=None, outframe=None, name=None):
-    global clip_counter
-    global subclip_counter
-    clip_counter += 1
-    mclip_id = "masterclip-%i" % (clip_counter)
-
-    clip = ET.SubElement(parent, "clip", id=mclip_id, frameBlend="FALSE")
-    subitems = [
-        ("uuid", str(uuid.uuid1())),
-        ("masterclipid", mclip_id),
-        ("ismasterclip", "TRUE"),
-        ("duration", finfo["duration"]),
-        ("name", name or os.path.split(fn)[-1]),
-    ]
-    if inframe or outframe:
-        subitems += [("in", str(inframe)), ("out", str(outframe))]
-
-    batch_node(subitems, clip)
-    rate = ET.SubElement(clip, "rate")
-    tb = ET.SubElement(rate, "timebase")
-    tb.text = finfo["timebase"]
-
-    media = ET.SubElement(clip, "media")
-
-    # Video Track
-    video = ET.SubElement(media, "video")
-    vtrack = ET.SubElement(video, "track")
-    subclip_counter += 1
-    vcitem = ET.SubElement(vtrack, "clipitem",
-                id="clipitem-%i" % subclip_counter,
-                frameBlend="FALSE")
-    subitems = [
-        ("masterclipid", mclip_id),
-        ("name", name or os.path.split(fn)[-1]),
-        ("alphatype", finfo["alpha"]),
-        # ("pixelaspectratio", finfo["par"]),
-        # ("anamorphic", finfo["anamorphic"]),
-        ]
-
-    batch_node(subitems, vcitem)
-    vfile = ET.SubElement(vcitem, "file", id="file-%i" % clip_counter)
-
-    rate = ET.SubElement(vfile, "rate")
-    tb = ET.SubElement(rate, "timebase")
-    tb.text = finfo["timebase"]
-
-    pathurl = path2url(fn)
-    subitems = [
-        ("name", name or os.path.split(fn)[-1]),
-        ("pathurl", pathurl),
-        ("duraiton", finfo["duration"]),
-    ]
-    batch_node(subitems, vfile)
-
-    submedia = ET.SubElement(vfile, "media")
-    mvideo = ET.SubElement(submedia, "video")
-    schar = ET.SubElement(mvideo, "subcharacteristics")
-    rate = ET.SubElement(schar, "rate")
-    tb = ET.SubElement(rate, "timebase")
-    tb.text = finfo["timebase"]
-    subitems = [
-        ("width", finfo["width"]),
-        ("height", finfo["height"]),
-        # ("anamorphic", finfo["anamorphic"]),
-        # ("pixelaspectratio", finfo["par"]),
-        ("fielddominance", finfo["FO"]),
-    ]
-    batch_node(subitems, schar)
-
-    maudio = ET.SubElement(submedia, "audio")
-    batch_node([("chanelcount", "2")], maudio)
-    schar = ET.SubElement(maudio, "subcharacteristics")
-    rate = ET.SubElement(schar, "rate")
-    tb = ET.SubElement(rate, "timebase")
-    tb.text = finfo["timebase"]
-    subitems = [
-        ("depth", finfo["adepth"]),
-        ("samplerate", finfo["asamrate"]),
-    ]
-    batch_node(subitems, schar)
-
-    # Audio Channels
-    if finfo["achans"] and finfo["achans"].isdigit():
-        audio = ET.SubElement(media, "audio")
-        for channel in range(int(finfo["achans"])):
-            atrack = ET.SubElement(audio, "track")
-            subclip_counter += 1
-            acitem = ET.SubElement(atrack,
-                                   "clipitem",
-                                   id="clipitem-%s" % subclip_counter,
-                                   frameBlend="FALSE")
-            masterc = ET.SubElement(acitem, "masterclip")
-            masterc.text = mclip_id
-            name = ET.SubElement(acitem, "name")
-            name.text = name or name or os.path.split(fn)[-1]
-            ET.SubElement(acitem, "file", id="file-%i" % clip_counter)
-            strack = ET.SubElement(acitem, "sourcetrack")
-            subitems = [('mediatrack', "audio"),
-                        ("trackindex", str(channel + 1))]
-            batch_node(subitems, strack)
-
-    return clip
-
-
-def make_xml(fn, scenes):
-    """Given a source file and a list of scene data, generate a
-    Final Cut Pro xml project."""
-    MI.Open(fn)
-    frate = MI.Get(Stream.Video, 0, u"FrameRate") or 30
+def get_file_info(meta):
+    """Convert a metadata record (see metadata.py) into the properties
+    needed for the xml."""
+    frate = meta.get("frame_rate") or 30
     finfo = {
-        "duration": MI.Get(Stream.Video, 0, u"FrameCount"),
+        "duration": str(meta["framecount"]),
         "timebase": "%i" % round(float(frate)),
         "alpha": "none",
         # "par": "square",
         # "anamporphic": "",
         "FO": "lower",
-        "width": MI.Get(Stream.Video, 0, u"Width"),
-        "height": MI.Get(Stream.Video, 0, u"Height"),
-        "adepth": MI.Get(Stream.Audio, 0, u"Resolution"),
-        "asamrate": MI.Get(Stream.Audio, 0, u"SamplingRate"),
-        "achans": MI.Get(Stream.Audio, 0, u"Channels"),
+        "width": str(meta["width"]),
+        "height": str(meta["height"]),
+        "adepth": meta.get("audio_depth", ""),
+        "asamrate": meta.get("audio_rate", ""),
+        "achans": meta.get("audio_channels", ""),
     }
-
-    root = ET.Element("xmeml", version="4")
-
-    project = ET.SubElement(root, "project")
-
-    name = ET.SubElement(project, "name")
-    name.text = "Test Project"
-
-    children = ET.SubElement(project, "children")
-
-    scene_bin = ET.SubElement(children, "bin")
-    scene_bin_name = ET.SubElement(scene_bin, "name")
-    scene_bin_name.text = "Scenes"
-
-    bin_kids = ET.SubElement(scene_bin, "children")
-
-    # Add the main clip
-    make_clip_xml(fn, children, finfo)
-    for i, item in enumerate(scenes):
-        make_clip_xml(item["vidpath"], bin_kids, finfo,
-                      inframe=item["start"], outframe=item["end"],
-                      name=item["title"])
-    tree = ET.ElementTree(root)
-    return tree
+    return finfo
+
+
+class XmlWriter(object):
+    """Writes a Final Cut Pro xmeml document to a file one clip at a time,
+    so memory use does not grow with the number of scenes. Clip ids are
+    counted per document, so several documents can be written at once.
+       Usage: writer = XmlWriter(f, finfo)
+              writer.write(fn, scenes)
+       """
+
+    def __init__(self, f, finfo):
+        self.f = f
+        self.finfo = finfo
+        self.clip_counter = 0
+        self.subclip_counter = 0
+
+    def make_clip_xml(self, fn, inframe=None, outframe=None, name=None):
+        """Return a detached clip element for the file or a part of it."""
+        finfo = self.finfo
+        self.clip_counter += 1
+        mclip_id = "masterclip-%i" % (self.clip_counter)
+        name = name or os.path.split(fn)[-1]
+
+        clip = ET.Element("clip", id=mclip_id, frameBlend="FALSE")
+        subitems = [
+            ("uuid", str(uuid.uuid1())),
+            ("masterclipid", mclip_id),
+            ("ismasterclip", "TRUE"),
+            ("duration", finfo["duration"]),
+            ("name", name),
+        ]
+        if inframe or outframe:
+            subitems += [("in", str(inframe)), ("out", str(outframe))]
+
+        batch_node(subitems, clip)
+        rate = ET.SubElement(clip, "rate")
+        tb = ET.SubElement(rate, "timebase")
+        tb.text = finfo["timebase"]
+
+        media = ET.SubElement(clip, "media")
+
+        # Video Track
+        video = ET.SubElement(media, "video")
+        vtrack = ET.SubElement(video, "track")
+        self.subclip_counter += 1
+        vcitem = ET.SubElement(vtrack, "clipitem",
+                    id="clipitem-%i" % self.subclip_counter,
+                    frameBlend="FALSE")
+        subitems = [
+            ("masterclipid", mclip_id),
+            ("name", name),
+            ("alphatype", finfo["alpha"]),
+            # ("pixelaspectratio", finfo["par"]),
+            # ("anamorphic", finfo["anamorphic"]),
+            ]
+
+        batch_node(subitems, vcitem)
+        vfile = ET.SubElement(vcitem, "file", id="file-%i" % self.clip_counter)
+
+        rate = ET.SubElement(vfile, "rate")
+        tb = ET.SubElement(rate, "timebase")
+        tb.text = finfo["timebase"]
+
+        pathurl = path2url(fn)
+        subitems = [
+            ("name", name),
+            ("pathurl", pathurl),
+            ("duraiton", finfo["duration"]),
+        ]
+        batch_node(subitems, vfile)
+
+        submedia = ET.SubElement(vfile, "media")
+        mvideo = ET.SubElement(submedia, "video")
+        schar = ET.SubElement(mvideo, "subcharacteristics")
+        rate = ET.SubElement(schar, "rate")
+        tb = ET.SubElement(rate, "timebase")
+        tb.text = finfo["timebase"]
+        subitems = [
+            ("width", finfo["width"]),
+            ("height", finfo["height"]),
+            # ("anamorphic", finfo["anamorphic"]),
+            # ("pixelaspectratio", finfo["par"]),
+            ("fielddominance", finfo["FO"]),
+        ]
+        batch_node(subitems, schar)
+
+        maudio = ET.SubElement(submedia, "audio")
+        batch_node([("chanelcount", "2")], maudio)
+        schar = ET.SubElement(maudio, "subcharacteristics")
+        rate = ET.SubElement(schar, "rate")
+        tb = ET.SubElement(rate, "timebase")
+        tb.text = finfo["timebase"]
+        subitems = [
+            ("depth", finfo["adepth"]),
+            ("samplerate", finfo["asamrate"]),
+        ]
+        batch_node(subitems, schar)
+
+        # Audio Channels
+        if finfo["achans"] and finfo["achans"].isdigit():
+            audio = ET.SubElement(media, "audio")
+            for channel in range(int(finfo["achans"])):
+                atrack = ET.SubElement(audio, "track")
+                self.subclip_counter += 1
+                acitem = ET.SubElement(atrack,
+                                       "clipitem",
+                                       id="clipitem-%s" % self.subclip_counter,
+                                       frameBlend="FALSE")
+                masterc = ET.SubElement(acitem, "masterclip")
+                masterc.text = mclip_id
+                aname = ET.SubElement(acitem, "name")
+                aname.text = name
+                ET.SubElement(acitem, "file", id="file-%i" % self.clip_counter)
+                strack = ET.SubElement(acitem, "sourcetrack")
+                subitems = [('mediatrack', "audio"),
+                            ("trackindex", str(channel + 1))]
+                batch_node(subitems, strack)
+
+        return clip
+
+    def write_clip(self, clip):
+        self.f.write(ET.tostring(clip))
+
+    def write(self, fn, scenes):
+        """Write the whole project: a bin holding a clip per scene followed
+        by a clip for the full source file."""
+        # The main clip is numbered first but written after the scene bin
+        main_clip = self.make_clip_xml(fn)
+        self.f.write('<?xml version="1.0" encoding="UTF-8"?>'
+                     '<!DOCTYPE xmeml>'
+                     '<xmeml version="4"><project>'
+                     '<name>Test Project</name><children>'
+                     '<bin><name>Scenes</name><children>')
+        for item in scenes:
+            self.write_clip(self.make_clip_xml(item["vidpath"],
+                                               inframe=item["start"],
+                                               outframe=item["end"],
+                                               name=item["title"]))
+        self.f.write('</children></bin>')
+        self.write_clip(main_clip)
+        self.f.write('</children></project></xmeml>')
+
+
+def write_xml(f, fn, scenes, meta):
+    """Given an open file, a source file, a list of scene data and the
+    source's metadata record, write a Final Cut Pro xml project."""
+    XmlWriter(f, get_file_info(meta)).write(fn, scenes)